@@ -0,0 +1,252 @@
+import argparse
+import json
+import random
+import statistics
+import sys
+import tracemalloc
+import uuid
+from itertools import islice
+from time import perf_counter
+
+import btree
+from btree import Btree, encode_key
+
+# Benchmark runner for btree.py. Every combination of operation, key
+# pattern, N and node capacity is run --repeats times on a fresh tree, and
+# its median time, spread and peak memory (from one more run under
+# tracemalloc) are printed and optionally written to a JSON file. Given a
+# baseline file from an earlier run, each result is compared against it.
+# With --tune, the operations of each pattern and N are instead run in
+# sequence as one workload over the grid of capacities, and the fastest
+# capacities are recommended.
+#
+#   python benchmark.py --sizes 1000 100000 --output after.json --baseline before.json
+#   python benchmark.py --tune --patterns random --sizes 100000
+
+OPS = ["insert", "get", "scan", "delete"]
+# uuid4 and uuid7 keys are encoded with encode_key; uuid7 keys are time
+# ordered, UUIDV7_PER_MS of them per millisecond
+PATTERNS = ["sequential", "random", "reverse", "clustered", "uuid4", "uuid7"]
+# keys of the clustered pattern come in runs of consecutive keys
+CLUSTER_SIZE = 100
+UUIDV7_PER_MS = 10
+# keys per range scan
+SCAN_LENGTH = 100
+# capacity grid of --tune
+TUNE_LEAF_CAPACITIES = [8, 13, 32, 64, 128]
+TUNE_INTERNAL_CAPACITIES = [16, 64, 128, 500]
+
+def make_row(i):
+    return {"id": i, "user": f"person{i}", "email": f"person{i}@example.com"}
+
+def make_uuid7(unix_ms: int, rnd: random.Random) -> uuid.UUID:
+    # RFC 9562 UUIDv7: 48-bit unix milliseconds, version 7, 12 random bits,
+    # variant 0b10, 62 random bits
+    value = (unix_ms << 80) | (0x7 << 76) | (rnd.getrandbits(12) << 64) | (0b10 << 62) | rnd.getrandbits(62)
+    return uuid.UUID(int=value)
+
+def make_keys(pattern: str, n: int, rnd: random.Random):
+    # the keys in insert order
+    if pattern == "uuid4":
+        return [encode_key(uuid.UUID(int=rnd.getrandbits(128), version=4)) for _ in range(n)]
+    if pattern == "uuid7":
+        start_ms = 1700000000000
+        return [encode_key(make_uuid7(start_ms + i // UUIDV7_PER_MS, rnd)) for i in range(n)]
+
+    keys = list(range(n))
+    if pattern == "random":
+        rnd.shuffle(keys)
+    elif pattern == "reverse":
+        keys.reverse()
+    elif pattern == "clustered":
+        # runs of CLUSTER_SIZE keys, the runs in random order
+        runs = [keys[i:i + CLUSTER_SIZE] for i in range(0, n, CLUSTER_SIZE)]
+        rnd.shuffle(runs)
+        keys = [key for run in runs for key in run]
+    elif pattern != "sequential":
+        raise Exception(f"Unknown key pattern {pattern}")
+    return keys
+
+def run_op(tree: Btree, op: str, keys, rows):
+    # op over keys in their pattern order
+    if op == "insert":
+        for key, val in zip(keys, rows):
+            tree.execute_insert(key, val)
+    elif op == "get":
+        for key in keys:
+            tree.get(key)
+    elif op == "scan":
+        # SCAN_LENGTH keys from every SCAN_LENGTH-th key, so that about N
+        # keys are scanned
+        for lo in keys[::SCAN_LENGTH]:
+            for _ in islice(tree.scan(lo), SCAN_LENGTH):
+                pass
+    elif op == "delete":
+        for key in keys:
+            tree.execute_delete(key)
+    else:
+        raise Exception(f"Unknown operation {op}")
+
+def run_once(op: str, keys, rows, leaf_capacity: int, internal_capacity: int):
+    # Time op on a new tree and return (time, tree). The tree to get, scan
+    # or delete from is built first, untimed.
+    tree = Btree(leaf_capacity=leaf_capacity, internal_capacity=internal_capacity)
+    if op != "insert":
+        run_op(tree, "insert", keys, rows)
+    t_start = perf_counter()
+    run_op(tree, op, keys, rows)
+    return perf_counter() - t_start, tree
+
+def run_workload(ops, keys, rows, leaf_capacity: int, internal_capacity: int) -> float:
+    # Time ops one after the other on a new tree, which starts out empty.
+    tree = Btree(leaf_capacity=leaf_capacity, internal_capacity=internal_capacity)
+    t_start = perf_counter()
+    for op in ops:
+        run_op(tree, op, keys, rows)
+    return perf_counter() - t_start
+
+def measure(op: str, pattern: str, n: int, leaf_capacity: int, internal_capacity: int,
+            repeats: int, seed: int):
+    keys = make_keys(pattern, n, random.Random(seed))
+    rows = [make_row(i) for i in range(n)]
+
+    times = []
+    for _ in range(repeats):
+        elapsed, tree = run_once(op, keys, rows, leaf_capacity, internal_capacity)
+        times.append(elapsed)
+
+    tracemalloc.start()
+    run_once(op, keys, rows, leaf_capacity, internal_capacity)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {"op": op, "pattern": pattern, "n": n,
+              "leaf_capacity": leaf_capacity, "internal_capacity": internal_capacity,
+              "repeats": repeats,
+              "median": statistics.median(times),
+              "min": min(times),
+              "max": max(times),
+              "stdev": statistics.stdev(times) if repeats > 1 else 0.0,
+              "peak_memory": peak_memory}
+    if op == "insert":
+        # the shape of the tree built and how it got there: split and
+        # insert (fast path) counts, height, fill factors; the same for
+        # every repeat
+        result["stats"] = tree.stats()
+    return result
+
+def tune(ops, keys, rows, leaf_capacities, internal_capacities, repeats: int):
+    # Run the workload (ops over keys, starting from an empty tree) for
+    # every pair of capacities and return (median, leaf_capacity,
+    # internal_capacity) for each, fastest first.
+    if ops[0] != "insert":
+        raise Exception("A workload to tune starts with insert")
+    timings = []
+    for leaf_capacity in leaf_capacities:
+        for internal_capacity in internal_capacities:
+            times = [run_workload(ops, keys, rows, leaf_capacity, internal_capacity)
+                     for _ in range(repeats)]
+            timings.append((statistics.median(times), leaf_capacity, internal_capacity))
+    return sorted(timings)
+
+def result_id(result):
+    return (result["op"], result["pattern"], result["n"],
+            result["leaf_capacity"], result["internal_capacity"])
+
+def format_result(result) -> str:
+    op, pattern, n, leaf_capacity, internal_capacity = result_id(result)
+    return (f"{op:<7} {pattern:<11} N={n:<8} leaf={leaf_capacity:<4} internal={internal_capacity:<4} "
+            f"median={result['median']:.4f}s spread=[{result['min']:.4f}, {result['max']:.4f}] "
+            f"stdev={result['stdev']:.4f} peak={result['peak_memory'] / 2 ** 20:.1f}MiB"
+            + (f" splits={result['stats']['split_counts']['leaf_node']} "
+               f"fast_path={result['stats']['insert_counts']['fast_path']}" if "stats" in result else ""))
+
+def compare(results, baseline, threshold: float) -> int:
+    # Print the change of each median against the baseline and return the
+    # number of results more than threshold slower.
+    baseline = {result_id(result): result for result in baseline}
+    num_slower = 0
+    for result in results:
+        before = baseline.get(result_id(result))
+        if before is None:
+            continue
+        ratio = result["median"] / before["median"]
+        if ratio > 1 + threshold:
+            verdict = "SLOWER"
+            num_slower += 1
+        elif ratio < 1 - threshold:
+            verdict = "faster"
+        else:
+            verdict = "same"
+        op, pattern, n, leaf_capacity, internal_capacity = result_id(result)
+        print(f"{op:<7} {pattern:<11} N={n:<8} leaf={leaf_capacity:<4} internal={internal_capacity:<4} "
+              f"{before['median']:.4f}s -> {result['median']:.4f}s ({ratio:.2f}x) {verdict}")
+    return num_slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark btree.py")
+    parser.add_argument("--ops", nargs="+", choices=OPS, default=OPS)
+    parser.add_argument("--patterns", nargs="+", choices=PATTERNS, default=PATTERNS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10 ** 3, 10 ** 4, 10 ** 5])
+    parser.add_argument("--leaf-capacities", nargs="+", type=int)
+    parser.add_argument("--internal-capacities", nargs="+", type=int)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change in median counted as faster or slower")
+    parser.add_argument("--tune", action="store_true",
+                        help="recommend node capacities for each pattern and N")
+    parser.add_argument("--sample-size", type=int,
+                        help="with --tune, run the workload on this many keys of each N")
+    args = parser.parse_args(argv)
+
+    if args.tune:
+        leaf_capacities = args.leaf_capacities or TUNE_LEAF_CAPACITIES
+        internal_capacities = args.internal_capacities or TUNE_INTERNAL_CAPACITIES
+        ops = [op for op in OPS if op in args.ops]
+        if ops[0] != "insert":
+            ops.insert(0, "insert")
+        for n in args.sizes:
+            for pattern in args.patterns:
+                # a sample of the workload: its first sample_size keys
+                keys = make_keys(pattern, n, random.Random(args.seed))[:args.sample_size]
+                rows = [make_row(i) for i in range(n)]
+                timings = tune(ops, keys, rows, leaf_capacities, internal_capacities, args.repeats)
+                for median, leaf_capacity, internal_capacity in timings[:3]:
+                    print(f"{pattern:<11} N={len(keys):<8} leaf={leaf_capacity:<4} "
+                          f"internal={internal_capacity:<4} median={median:.4f}s")
+                _, leaf_capacity, internal_capacity = timings[0]
+                print(f"Recommended for {pattern} ({' '.join(ops)}): "
+                      f"Btree(leaf_capacity={leaf_capacity}, internal_capacity={internal_capacity})",
+                      flush=True)
+        return 0
+
+    leaf_capacities = args.leaf_capacities or [btree.LEAF_NODE_MAX_CELLS]
+    internal_capacities = args.internal_capacities or [btree.INTERNAL_NODE_MAX_CELLS]
+    results = []
+    for leaf_capacity in leaf_capacities:
+        for internal_capacity in internal_capacities:
+            for n in args.sizes:
+                for pattern in args.patterns:
+                    for op in args.ops:
+                        result = measure(op, pattern, n, leaf_capacity, internal_capacity,
+                                         args.repeats, args.seed)
+                        print(format_result(result), flush=True)
+                        results.append(result)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version, "results": results}, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print()
+        if compare(results, baseline, args.threshold) > 0:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
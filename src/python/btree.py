@@ -1,26 +1,113 @@
-import copy
+import abc
+import functools
+import heapq
+import math
+import multiprocessing
+import os
 import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
 from typing import Union
 
 # Contstants
 LEAF_NODE_MAX_CELLS = 13
-LEAF_NODE_RIGHT_SPLIT_COUNT = (LEAF_NODE_MAX_CELLS + 1) // 2
-LEAF_NODE_LEFT_SPLIT_COUNT = (LEAF_NODE_MAX_CELLS + 1) - LEAF_NODE_RIGHT_SPLIT_COUNT
 
-INTERNAL_NODE_MAX_KEYS = 510
+# most internal keys that fit in a page next to the trailer of page 0
+# (see FILE_TRAILER)
+INTERNAL_NODE_MAX_KEYS = 509
 
 # Keep this small for testing
 #INTERNAL_NODE_MAX_CELLS = 3
 INTERNAL_NODE_MAX_CELLS = 500
 
+# cells a concurrent scan copies out of the leaves per descent
+SCAN_BATCH_CELLS = 1024
+
+# a sharded tree moves keys between shards once a shard holds more than
+# SHARD_REBALANCE_RATIO times the mean and at least SHARD_REBALANCE_MIN_KEYS
+SHARD_REBALANCE_RATIO = 1.5
+SHARD_REBALANCE_MIN_KEYS = 4096
+# inserts buffered per shard before they are sent
+SHARD_BATCH_SIZE = 4096
+
+# buckets of the per-level fill factor histograms of Btree.stats
+FILL_HISTOGRAM_BINS = 10
+
 # value for invalid page nums
 INVALID_PAGE_NUM = -1
 
+# On-disk page layout, the same as in src/c/db.c
+PAGE_SIZE = 4096
+NODE_INTERNAL = 0
+NODE_LEAF = 1
+# Not in db.c: a page released by a FilePager, with the next free page in
+# the parent pointer slot. No node points to it.
+NODE_FREE = 2
+DISK_INVALID_PAGE_NUM = 0xFFFFFFFF # UINT32_MAX
+# common header: node type (u8), is_root (u8), parent pointer (u32).
+# Splits follow the descent path, so the parent pointer slot holds the
+# subtree max key of internal nodes instead.
+COMMON_NODE_HEADER = struct.Struct("<BBI")
+# Not in db.c: FILE_MAGIC (u32) and the first free page (u32) in the last
+# bytes of page 0, after the root's cells. Page 0 is the root and never
+# free, so 0 ends the free list. A file without FILE_MAGIC was written by
+# db.c, which leaves these bytes uninitialised and keeps parent pointers in
+# internal nodes: it has no free list and its max keys are rebuilt on open.
+FILE_TRAILER = struct.Struct("<II")
+FILE_TRAILER_OFFSET = PAGE_SIZE - FILE_TRAILER.size
+FILE_MAGIC = 0x79707462 # "btpy"
+# leaf header: common header, num_cells (u32), next_leaf (u32)
+LEAF_NODE_HEADER = struct.Struct("<BBIII")
+# internal header: common header, num_keys (u32), right_child (u32)
+INTERNAL_NODE_HEADER = struct.Struct("<BBIII")
+# Row: id (u32), username (32 chars + NUL), email (255 chars + NUL)
+COLUMN_USERNAME_SIZE = 32
+COLUMN_EMAIL_SIZE = 255
+ROW = struct.Struct(f"<I{COLUMN_USERNAME_SIZE + 1}s{COLUMN_EMAIL_SIZE + 1}s")
+# WAL record: op (u8), key or page num (u32), payload length (u32), then the
+# payload and a crc32 of header and payload (u32)
+WAL_RECORD_HEADER = struct.Struct("<BII")
+WAL_RECORD_CRC = struct.Struct("<I")
+WAL_INSERT = 1
+WAL_DELETE = 2
+WAL_PAGE = 3
+WAL_CHECKPOINT_END = 4
+# leaf cell: key (u32) followed by the row
+LEAF_NODE_CELL = struct.Struct(f"<I{ROW.size}s")
+# internal cell: child pointer (u32), key (u32)
+INTERNAL_NODE_CELL = struct.Struct("<II")
+# Key codec type tags (see encode_key); encoded keys of different types
+# sort in the order of their tags. Numbers of all types share the tags
+# from KEY_NEG_INF to KEY_POS_INF.
+KEY_NONE = 0x00
+KEY_BYTES = 0x01
+KEY_STR = 0x02
+KEY_TUPLE = 0x05
+KEY_NEG_INF = 0x0a
+KEY_INT_NEG_LONG = 0x0b # below -(2^64 - 1), followed by a length byte
+KEY_INT_ZERO = 0x14 # KEY_INT_ZERO +- n for ints of n bytes, n <= 8
+KEY_INT_POS_LONG = 0x1d
+KEY_POS_INF = 0x1e
+KEY_UUID = 0x30
+# follows the floor of a float key that is not integral, and is followed by
+# its fraction; above every tag, so that the float sorts after its floor
+# and whatever follows the floor in a tuple
+KEY_FRACTION = 0xff
+# most leaf cells that fit in a page next to the trailer of page 0
+# (INTERNAL_NODE_MAX_KEYS for internal nodes)
+LEAF_NODE_PAGE_MAX_CELLS = (FILE_TRAILER_OFFSET - LEAF_NODE_HEADER.size) // LEAF_NODE_CELL.size
+
 class BtreeNode:
     def __init__(self, is_root = False):
         # common fields
         self._is_root = is_root
-        self._parent_ptr = 0
 
     def is_root(self):
         return self._is_root
@@ -28,34 +115,25 @@ class BtreeNode:
     def set_is_root(self, is_root: bool):
         self._is_root = is_root
 
-    def get_parent_ptr(self):
-        return self._parent_ptr
-
-    def set_parent_ptr(self, ptr):
-        self._parent_ptr = ptr
-
 class BtreeNodeLeaf(BtreeNode):
     def __init__(self, is_root = False):
         super().__init__(is_root)
-        self._num_cells = 0
         self._next_leaf_ptr = 0 # 0 represents no sibling
-        # preallocate cells array
-        self._cell_list = [(0, {})] * LEAF_NODE_MAX_CELLS # (key, val)
-
-    def copy(self):
-        n = BtreeNodeLeaf()
-        n._is_root = self._is_root
-        n._parent_ptr = self._parent_ptr
-        n._num_cells = self._num_cells
+        # keys and values are kept in parallel lists so that searches can
+        # bisect the keys directly and shifts are single slice operations
+        self._keys = []
+        self._vals = []
+
+    def clone(self):
+        # copy of the node with its own cell lists; keys and values are shared
+        n = BtreeNodeLeaf(self._is_root)
         n._next_leaf_ptr = self._next_leaf_ptr
-        n._cell_list = copy.deepcopy(self._cell_list)
+        n._keys = self._keys.copy()
+        n._vals = self._vals.copy()
         return n
 
     def get_num_cells(self):
-        return self._num_cells
-
-    def set_num_cells(self, num_cells: int):
-        self._num_cells = num_cells
+        return len(self._keys)
 
     def get_next_leaf_ptr(self):
         return self._next_leaf_ptr
@@ -64,55 +142,405 @@ class BtreeNodeLeaf(BtreeNode):
         self._next_leaf_ptr = ptr
 
     def get_cell(self, cell_num: int):
-        return self._cell_list[cell_num]
+        return self._keys[cell_num], self._vals[cell_num]
 
     def set_cell(self, cell_num, cell):
-        self._cell_list[cell_num] = cell
+        self._keys[cell_num], self._vals[cell_num] = cell
+
+    def insert_cell(self, cell_num: int, key, val):
+        self._keys.insert(cell_num, key)
+        self._vals.insert(cell_num, val)
+
+    def delete_cell(self, cell_num: int):
+        del self._keys[cell_num]
+        del self._vals[cell_num]
+
+    def insert_cells(self, keys, vals):
+        # Insert sorted keys that are not in the leaf yet, together with
+        # their values. Each search starts at the previous insert position.
+        cell_num = 0
+        for key, val in zip(keys, vals):
+            cell_num = bisect_left(self._keys, key, cell_num)
+            self._keys.insert(cell_num, key)
+            self._vals.insert(cell_num, val)
+
+    def find_duplicate(self, keys):
+        # Return the first of the sorted keys that is already in the leaf,
+        # or None.
+        cell_num = 0
+        num_cells = len(self._keys)
+        for key in keys:
+            cell_num = bisect_left(self._keys, key, cell_num)
+            if cell_num == num_cells:
+                return None
+            if self._keys[cell_num] == key:
+                return key
+        return None
+
+    def find_values(self, keys, default=None):
+        # Return the values of the sorted keys, with default for keys that
+        # are not in the leaf. Each search starts at the previous position.
+        out = []
+        cell_num = 0
+        num_cells = len(self._keys)
+        for key in keys:
+            cell_num = bisect_left(self._keys, key, cell_num)
+            if cell_num < num_cells and self._keys[cell_num] == key:
+                out.append(self._vals[cell_num])
+            else:
+                out.append(default)
+        return out
+
+    def truncate_cells(self, num_cells: int):
+        # Remove every cell from num_cells onwards and return them as
+        # (keys, vals) so they can be handed to extend_cells.
+        keys = self._keys[num_cells:]
+        vals = self._vals[num_cells:]
+        del self._keys[num_cells:]
+        del self._vals[num_cells:]
+        return keys, vals
+
+    def extend_cells(self, keys, vals):
+        self._keys.extend(keys)
+        self._vals.extend(vals)
 
     def get_key(self, cell_num: int):
-        k, _ = self.get_cell(cell_num) # (key, val)
-        return k
+        return self._keys[cell_num]
+
+    def get_value(self, cell_num: int):
+        return self._vals[cell_num]
+
+    def find_cell(self, key) -> int:
+        # Return the index of key, or the position it would be inserted at.
+        return bisect_left(self._keys, key)
+
+    def find_cell_after(self, key, lo: int = 0) -> int:
+        # Return the index of the first cell from lo with a key above key.
+        return bisect_right(self._keys, key, lo)
+
+    def get_cells(self, start: int, end: int):
+        # (key, val) pairs of cells start to end, taken with one slice each
+        return zip(self._keys[start:end], self._vals[start:end])
+
+    def get_field(self, cell_num: int, field):
+        return self._vals[cell_num][field]
+
+    def get_field_cells(self, field, start: int, end: int):
+        # (key, val[field]) pairs of cells start to end
+        return zip(self._keys[start:end], [val[field] for val in self._vals[start:end]])
 
     def get_max_key_internal(self) -> int:
-        k, _ = self.get_cell(self._num_cells - 1)
-        return k
-    
+        return self._keys[-1]
+
+    def get_max_key(self) -> int:
+        # max key in the subtree rooted at this node
+        return self._keys[-1]
+
+class RowLayout:
+    # Fixed-size binary layout of row dicts, given as (name, struct format
+    # code) pairs in field order. Strings ("Ns" fields) are stored UTF-8
+    # encoded and NUL terminated, as in db.c. ROW_LAYOUT is the Row of db.c.
+    def __init__(self, fields):
+        self._names = tuple(name for name, _ in fields)
+        self._row = struct.Struct("<" + "".join(code for _, code in fields))
+        self._is_str = tuple(code.endswith("s") for _, code in fields)
+        self._str_sizes = {name: struct.calcsize(code) for name, code in fields if code.endswith("s")}
+        # per field, a struct of the whole row that skips all other fields,
+        # so that a field is read out of any number of rows with iter_unpack
+        self._fields = {}
+        offset = 0
+        for name, code in fields:
+            size = struct.calcsize("<" + code)
+            self._fields[name] = (struct.Struct(f"<{offset}x{code}{self._row.size - offset - size}x"),
+                                  code.endswith("s"))
+            offset += size
+        self._str_indexes = [i for i, is_str in enumerate(self._is_str) if is_str]
+
+    def get_size(self) -> int:
+        return self._row.size
+
+    def get_names(self):
+        return self._names
+
+    def pack(self, val) -> bytes:
+        values = []
+        for name, is_str in zip(self._names, self._is_str):
+            value = val[name]
+            if is_str:
+                value = value.encode()
+                if len(value) >= self._str_sizes[name]:
+                    raise Exception(f"Field {name} is too long: {len(value)} bytes, "
+                                    f"at most {self._str_sizes[name] - 1} fit")
+            values.append(value)
+        return self._row.pack(*values)
+
+    def unpack_from(self, buf, offset: int = 0):
+        values = list(self._row.unpack_from(buf, offset))
+        for i in self._str_indexes:
+            values[i] = values[i].split(b"\0", 1)[0].decode()
+        return dict(zip(self._names, values))
+
+    def view_many(self, data: bytes):
+        # PackedRow views of all rows packed in data, which must not change
+        return map(functools.partial(PackedRow, self, data), range(0, len(data), self._row.size))
+
+    def unpack_field_from(self, buf, field, offset: int = 0):
+        field_struct, is_str = self.get_field_struct(field)
+        value, = field_struct.unpack_from(buf, offset)
+        return value.split(b"\0", 1)[0].decode() if is_str else value
+
+    def unpack_field_many(self, buf, field):
+        # field of all rows packed in buf
+        field_struct, is_str = self.get_field_struct(field)
+        if is_str:
+            return [value.split(b"\0", 1)[0].decode() for value, in field_struct.iter_unpack(buf)]
+        return [value for value, in field_struct.iter_unpack(buf)]
+
+    def get_field_struct(self, field):
+        if field not in self._fields:
+            raise Exception(f"Unknown field {field}")
+        return self._fields[field]
+
+ROW_LAYOUT = RowLayout([("id", "I"),
+                        ("user", f"{COLUMN_USERNAME_SIZE + 1}s"),
+                        ("email", f"{COLUMN_EMAIL_SIZE + 1}s")])
+
+class PackedRow(Mapping):
+    # A row read in place out of packed bytes, which must not change. A
+    # field is decoded when it is looked up, and dict(row) decodes them all.
+    # Compares equal to the row dict it was packed from.
+    __slots__ = ("_layout", "_data", "_offset")
+
+    def __init__(self, layout: RowLayout, data: bytes, offset: int = 0):
+        self._layout = layout
+        self._data = data
+        self._offset = offset
+
+    def __getitem__(self, field):
+        if field not in self._layout.get_names():
+            raise KeyError(field)
+        return self._layout.unpack_field_from(self._data, field, self._offset)
+
+    def __iter__(self):
+        return iter(self._layout.get_names())
+
+    def __len__(self):
+        return len(self._layout.get_names())
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class PackedRows:
+    # Rows cut out of a packed leaf, still packed. Another packed leaf with
+    # the same layout takes them over as they are; to anything else they
+    # are a sequence of PackedRow views.
+    def __init__(self, layout: RowLayout, data: bytes):
+        self._layout = layout
+        self._data = data
+
+    def __len__(self):
+        return len(self._data) // self._layout.get_size()
+
+    def __iter__(self):
+        return self._layout.view_many(self._data)
+
+    def __getitem__(self, index):
+        row_size = self._layout.get_size()
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            return PackedRows(self._layout, self._data[start * row_size:max(start, stop) * row_size])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("PackedRows index out of range")
+        return PackedRow(self._layout, self._data, index * row_size)
+
+class BtreeNodePackedLeaf(BtreeNodeLeaf):
+    # Leaf that keeps its values packed one after the other in a bytearray
+    # in a RowLayout instead of as row dicts. Values are handed out as
+    # PackedRow views over a copy of their bytes, which decode a field when
+    # it is looked up, and get_field reads a single field without a view.
+    def __init__(self, layout: RowLayout, is_root = False):
+        BtreeNode.__init__(self, is_root)
+        self._next_leaf_ptr = 0
+        self._keys = []
+        self._layout = layout
+        self._row_size = layout.get_size()
+        self._rows = bytearray()
+
+    def clone(self):
+        n = BtreeNodePackedLeaf(self._layout, self._is_root)
+        n._next_leaf_ptr = self._next_leaf_ptr
+        n._keys = self._keys.copy()
+        n._rows = self._rows.copy()
+        return n
+
+    def pack_rows(self, vals) -> bytes:
+        if isinstance(vals, PackedRows) and vals._layout is self._layout:
+            return vals._data
+        return b"".join(self._layout.pack(val) for val in vals)
+
+    def get_cell(self, cell_num: int):
+        return self._keys[cell_num], self.get_value(cell_num)
+
+    def set_cell(self, cell_num, cell):
+        key, val = cell
+        self._keys[cell_num] = key
+        offset = cell_num * self._row_size
+        self._rows[offset:offset + self._row_size] = self._layout.pack(val)
+
+    def insert_cell(self, cell_num: int, key, val):
+        self._keys.insert(cell_num, key)
+        offset = cell_num * self._row_size
+        self._rows[offset:offset] = self._layout.pack(val)
+
+    def delete_cell(self, cell_num: int):
+        del self._keys[cell_num]
+        offset = cell_num * self._row_size
+        del self._rows[offset:offset + self._row_size]
+
+    def insert_cells(self, keys, vals):
+        # as BtreeNodeLeaf.insert_cells
+        cell_num = 0
+        for key, val in zip(keys, vals):
+            cell_num = bisect_left(self._keys, key, cell_num)
+            self.insert_cell(cell_num, key, val)
+
+    def find_values(self, keys, default=None):
+        out = []
+        cell_num = 0
+        num_cells = len(self._keys)
+        for key in keys:
+            cell_num = bisect_left(self._keys, key, cell_num)
+            if cell_num < num_cells and self._keys[cell_num] == key:
+                out.append(self.get_value(cell_num))
+            else:
+                out.append(default)
+        return out
+
+    def truncate_cells(self, num_cells: int):
+        # the values come back as PackedRows, so that moving cells between
+        # packed leaves copies bytes only
+        keys = self._keys[num_cells:]
+        offset = num_cells * self._row_size
+        rows = PackedRows(self._layout, bytes(self._rows[offset:]))
+        del self._keys[num_cells:]
+        del self._rows[offset:]
+        return keys, rows
+
+    def extend_cells(self, keys, vals):
+        self._keys.extend(keys)
+        self._rows.extend(self.pack_rows(vals))
+
+    def get_value(self, cell_num: int):
+        offset = cell_num * self._row_size
+        return PackedRow(self._layout, bytes(memoryview(self._rows)[offset:offset + self._row_size]))
+
+    def get_cells(self, start: int, end: int):
+        # one copy of the rows for all views, so that they outlive changes
+        # to the leaf
+        rows = bytes(memoryview(self._rows)[start * self._row_size:end * self._row_size])
+        return zip(self._keys[start:end], self._layout.view_many(rows))
+
+    def get_field(self, cell_num: int, field):
+        return self._layout.unpack_field_from(self._rows, field, cell_num * self._row_size)
+
+    def get_field_cells(self, field, start: int, end: int):
+        rows = memoryview(self._rows)[start * self._row_size:end * self._row_size]
+        return zip(self._keys[start:end], self._layout.unpack_field_many(rows, field))
 
 
 class BtreeNodeInternal(BtreeNode):
     def __init__(self, is_root = False):
         super().__init__(is_root)
-        self._num_keys = 0
         self._right_child_pointer = INVALID_PAGE_NUM
-        # preallocate cells array
-        self._cell_list = [(0, 0)] * INTERNAL_NODE_MAX_KEYS # (child pointer, key)
-
-    def copy(self):
-        n = BtreeNodeInternal()
-        n._is_root = self._is_root
-        n._parent_ptr = self._parent_ptr
-        n._num_keys = self._num_keys
+        # max key in the subtree, kept up to date on insert and split
+        # so it never has to be found by walking down the right spine
+        self._max_key = None
+        # cells are kept as parallel lists so that searches can bisect the
+        # keys and splits can move cells with slices
+        self._child_ptrs = []
+        self._keys = []
+
+    def clone(self):
+        # copy of the node with its own cell lists
+        n = BtreeNodeInternal(self._is_root)
         n._right_child_pointer = self._right_child_pointer
-        n._cell_list = copy.deepcopy(self._cell_list)
+        n._max_key = self._max_key
+        n._child_ptrs = self._child_ptrs.copy()
+        n._keys = self._keys.copy()
         return n
 
-    def get_type(self):
-        return self._node_type
-
     def get_num_keys(self):
-        return self._num_keys
-
-    def set_num_keys(self, num_keys: int):
-        self._num_keys = num_keys
+        return len(self._keys)
 
     def get_num_cells(self):
-        return self._num_keys
+        return len(self._keys)
 
     def get_cell(self, cell_num: int):
-        return self._cell_list[cell_num]
+        return self._child_ptrs[cell_num], self._keys[cell_num] # (child pointer, key)
 
     def set_cell(self, cell_num: int, cell):
-        self._cell_list[cell_num] = cell
+        self._child_ptrs[cell_num], self._keys[cell_num] = cell
+
+    def set_cells(self, child_ptrs, keys, right_child_ptr: int):
+        self._child_ptrs = child_ptrs
+        self._keys = keys
+        self._right_child_pointer = right_child_ptr
+
+    def insert_child(self, child_index: int, left_max_key: int, new_child_ptr: int):
+        # The child at child_index was split. It keeps its position with
+        # left_max_key as its key, and new_child_ptr is added to its right,
+        # taking over the split child's old key.
+        if child_index == len(self._keys):
+            self._child_ptrs.append(self._right_child_pointer)
+            self._keys.append(left_max_key)
+            self._right_child_pointer = new_child_ptr
+        else:
+            self._child_ptrs.insert(child_index + 1, new_child_ptr)
+            self._keys.insert(child_index, left_max_key)
+
+    def remove_child(self, child_index: int):
+        # The child at child_index + 1 was merged into the child at
+        # child_index, which takes over its key (or its place as right child).
+        if child_index + 1 == len(self._keys):
+            self._right_child_pointer = self._child_ptrs.pop(child_index)
+            del self._keys[child_index]
+        else:
+            del self._keys[child_index]
+            del self._child_ptrs[child_index + 1]
+
+    def take_cells(self):
+        # Remove all cells and return them as (child_ptrs, keys, right_child_ptr).
+        cells = self._child_ptrs, self._keys, self._right_child_pointer
+        self._child_ptrs = []
+        self._keys = []
+        self._right_child_pointer = INVALID_PAGE_NUM
+        return cells
+
+    def extend_cells(self, child_ptrs, keys, right_child_ptr: int, max_key: int):
+        # Append the cells of the right sibling. The old right child moves
+        # into the cells, keyed by this node's max key.
+        self._child_ptrs.append(self._right_child_pointer)
+        self._keys.append(self._max_key)
+        self._child_ptrs.extend(child_ptrs)
+        self._keys.extend(keys)
+        self._right_child_pointer = right_child_ptr
+        self._max_key = max_key
+
+    def truncate_cells(self, split_index: int):
+        # Keep the cells below split_index and make the child at split_index
+        # the right child. Return the cells above it and the old right child
+        # as (child_ptrs, keys, right_child_ptr) for set_cells.
+        child_ptrs = self._child_ptrs[split_index + 1:]
+        keys = self._keys[split_index + 1:]
+        right_child_ptr = self._right_child_pointer
+        self._right_child_pointer = self._child_ptrs[split_index]
+        del self._child_ptrs[split_index:]
+        del self._keys[split_index:]
+        return child_ptrs, keys, right_child_ptr
 
     def get_right_child_ptr(self):
         return self._right_child_pointer
@@ -121,83 +549,986 @@ class BtreeNodeInternal(BtreeNode):
         self._right_child_pointer = ptr
 
     def get_key(self, cell_num: int):
-        _, k = self.get_cell(cell_num) # (child pointer, key)
-        return k
+        return self._keys[cell_num]
+
+    def set_key(self, cell_num: int, key: int):
+        self._keys[cell_num] = key
 
     def get_max_key_internal(self) -> int:
-        _, k = self.get_cell(self._num_keys - 1)
-        return k
+        return self._keys[-1]
+
+    def get_max_key(self) -> int:
+        # max key in the subtree rooted at this node
+        return self._max_key
+
+    def set_max_key(self, max_key: int):
+        self._max_key = max_key
 
     def get_child_ptr(self, child_num: int) -> int:
-        if child_num > self._num_keys:
-            msg = f"Tried to access child_num {child_num} > num_keys {self._num_keys}"
+        num_keys = len(self._keys)
+        if child_num > num_keys:
+            msg = f"Tried to access child_num {child_num} > num_keys {num_keys}"
             raise Exception(msg)
 
-        if child_num == self._num_keys:
+        if child_num == num_keys:
             #return self._right_child_pointer
             right_child = self.get_right_child_ptr()
             if right_child == INVALID_PAGE_NUM:
                 raise Exception("Tried to access right child of node, but was invalid page")
             return right_child
         else:
-            child, _ = self._cell_list[child_num]
+            child = self._child_ptrs[child_num]
             if child == INVALID_PAGE_NUM:
-                raise Exception("Tried to access child %d of node, but was invalid page")
+                raise Exception(f"Tried to access child {child_num} of node, but was invalid page")
             return child
 
     def find_child(self, key: int) -> int:
         # Return the index of the child which should contain
-        # the given key.
-        num_keys = self.get_num_keys()
-
-        # Binary search
-        min_index = 0
-        max_index = num_keys # there is one more child than key
-        while min_index != max_index:
-            index = (min_index + max_index) // 2
-            key_to_right = self.get_key(cell_num=index)
-            if key_to_right >= key:
-                max_index = index
-            else:
-                min_index = index + 1
-        return min_index
-
-    def update_key(self, old_key: int, new_key: int):
-        old_child_index = self.find_child(old_key)
-        child_ptr, _ = self.get_cell(old_child_index)
-        self.set_cell(old_child_index, (child_ptr, new_key))
+        # the given key (there is one more child than key).
+        return bisect_left(self._keys, key)
+
+class SplitPolicy(abc.ABC):
+    # Decides where a full node is split. split_point is given the number of
+    # cells in the overfull node (for internal nodes: children), the index
+    # the new cell was inserted at, whether the node is the rightmost one on
+    # its level, and whether it is a leaf. It returns how many cells stay
+    # in the left node. Subclasses must implement it.
+    @abc.abstractmethod
+    def split_point(self, num_cells: int, insert_index: int, is_rightmost: bool, is_leaf: bool) -> int:
+        pass
+
+    def record_insert(self, page_num: int, cell_num: int, num_cells: int) -> None:
+        # Called for every leaf insert with the leaf page, the insert
+        # position and the number of cells in the leaf before the insert.
+        pass
+
+class EvenSplitPolicy(SplitPolicy):
+    # Divide cells evenly, left node gets the extra cell (default).
+    def split_point(self, num_cells: int, insert_index: int, is_rightmost: bool, is_leaf: bool) -> int:
+        return num_cells - num_cells // 2
+
+class AppendSplitPolicy(EvenSplitPolicy):
+    # When inserting at the end of the rightmost node, keep left_fill of the
+    # cells in the left node, so monotonically increasing keys leave packed
+    # nodes behind them. Any other split is even.
+    def __init__(self, left_fill: float = 0.9):
+        if not 0 < left_fill <= 1:
+            raise Exception(f"left_fill must be in (0, 1], got {left_fill}")
+        self._left_fill = left_fill
+
+    def append_split_point(self, num_cells: int) -> int:
+        # keep at least one cell on each side
+        left_count = round((num_cells - 1) * self._left_fill)
+        return min(max(left_count, 1), num_cells - 1)
+
+    def split_point(self, num_cells: int, insert_index: int, is_rightmost: bool, is_leaf: bool) -> int:
+        if is_rightmost and insert_index == num_cells - 1:
+            return self.append_split_point(num_cells)
+        return super().split_point(num_cells, insert_index, is_rightmost, is_leaf)
+
+class AdaptiveSplitPolicy(AppendSplitPolicy):
+    # Chooses the split point from the recent insert pattern:
+    # - while most recent leaf inserts land at the end (start) of their
+    #   leaf, a node split at its end (start) keeps most cells on the left
+    #   (right), whether or not it is the rightmost node
+    # - if the last inserts into a leaf were at consecutive positions in
+    #   its middle (an ascending run inside a cluster of keys), the leaf is
+    #   split right after the new cell so the run can keep appending
+    # Everything else is split evenly.
+    RUN_LENGTH = 2
+    MAX_TRACKED_PAGES = 1024
+
+    def __init__(self, left_fill: float = 0.9, decay: float = 0.9, threshold: float = 0.5):
+        super().__init__(left_fill)
+        self._decay = decay
+        self._threshold = threshold
+        self._append_rate = 0.0
+        self._prepend_rate = 0.0
+        # page_num -> (last insert position, length of run of consecutive positions)
+        self._runs = {}
+        self._in_run = False
+
+    def record_insert(self, page_num: int, cell_num: int, num_cells: int) -> None:
+        self._append_rate *= self._decay
+        self._prepend_rate *= self._decay
+        if cell_num == num_cells:
+            self._append_rate += 1 - self._decay
+        elif cell_num == 0:
+            self._prepend_rate += 1 - self._decay
+
+        last_cell_num, run_length = self._runs.get(page_num, (-2, 0))
+        run_length = run_length + 1 if cell_num == last_cell_num + 1 else 0
+        if len(self._runs) >= self.MAX_TRACKED_PAGES:
+            self._runs.clear()
+        self._runs[page_num] = (cell_num, run_length)
+        self._in_run = run_length >= self.RUN_LENGTH
+
+    def split_point(self, num_cells: int, insert_index: int, is_rightmost: bool, is_leaf: bool) -> int:
+        if insert_index == num_cells - 1 and self._append_rate > self._threshold:
+            return self.append_split_point(num_cells)
+        if insert_index == 0 and self._prepend_rate > self._threshold:
+            return num_cells - self.append_split_point(num_cells)
+        if is_leaf and self._in_run and 0 < insert_index < num_cells - 1:
+            return insert_index + 1
+        return num_cells - num_cells // 2
 
 class Pager:
-    def __init__(self):
+    def __init__(self, row_layout: RowLayout = None):
+        # leaves pack their values in row_layout if one is given (see
+        # BtreeNodePackedLeaf)
+        self._row_layout = row_layout
         self._next_page = 1
         self._node_map = {}
+        # page nums released by deletes, handed out again before new ones
+        self._free_pages = []
+        # Copy-on-write versions for snapshots. Snapshot e sees every page
+        # as it was before epoch e + 1 began. A page written in an older
+        # epoch while a snapshot may still see it is copied first, and the
+        # old node is kept in _versions as (created, superseded, node).
+        self._epoch = 0
+        self._page_epochs = {} # epoch each current page was created in
+        self._versions = {}
+        self._snapshot_epochs = {} # epoch -> number of live snapshots
+        # page allocation and release may come from several threads
+        self._lock = threading.RLock()
+        # get_page counts
+        self._cache_hits = 0
+        self._cache_misses = 0
 
     def get_unused_page_num(self):
-        out = self._next_page
-        self._next_page += 1
-        return out
+        with self._lock:
+            if self._free_pages:
+                out = self._free_pages.pop()
+            else:
+                out = self._next_page
+                self._next_page += 1
+            self._page_epochs[out] = self._epoch
+            return out
+
+    def get_page_cow(self, page_num: int) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
+        # get_page while snapshots are live (see snapshot)
+        node = self.load_page(page_num)
+        if self.save_version(page_num, node):
+            # write to a copy, the snapshots keep the old node
+            node = node.clone()
+            self.store_page(page_num, node)
+        return node
+
+    def load_page(self, page_num: int) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
+        # get_page of the pager class, bypassing copy-on-write
+        return type(self).get_page(self, page_num)
 
     def get_page(self, page_num: int) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
         # cache-hit
         if page_num in self._node_map:
+            self._cache_hits += 1
             return self._node_map[page_num]
 
         # cache-miss
         # create and return new node (default leaf)
-        n = BtreeNodeLeaf(is_root=False)
+        self._cache_misses += 1
+        n = self.new_leaf()
         self._node_map[page_num] = n
         return n
 
+    def begin_operation(self):
+        # Called by the Btree before an insert, delete, bulk load or compact
+        # (see pager_operation). Nodes of this pager stay in memory anyway.
+        pass
+
+    def end_operation(self):
+        pass
+
+    def new_leaf(self, is_root: bool = False) -> BtreeNodeLeaf:
+        if self._row_layout is not None:
+            return BtreeNodePackedLeaf(self._row_layout, is_root=is_root)
+        return BtreeNodeLeaf(is_root=is_root)
+
+    def has_page(self, page_num: int) -> bool:
+        return page_num in self._node_map
+
     def set_page(self, page_num, node):
+        if self._snapshot_epochs and self.has_page(page_num):
+            self.save_version(page_num, self.load_page(page_num))
+        self._page_epochs[page_num] = self._epoch
+        self.store_page(page_num, node)
+
+    def store_page(self, page_num, node):
         self._node_map[page_num] = node
 
+    def free_page(self, page_num: int):
+        with self._lock:
+            if self._snapshot_epochs:
+                self.save_version(page_num, self.load_page(page_num))
+            self._node_map.pop(page_num, None)
+            self._free_pages.append(page_num)
+
+    def save_version(self, page_num: int, node) -> bool:
+        # Keep node, the current version of the page, if a live snapshot
+        # can see it and it is about to be replaced. Return whether it was kept.
+        created = self._page_epochs.get(page_num, 0)
+        if created == self._epoch or max(self._snapshot_epochs) < created:
+            return False
+        self._versions.setdefault(page_num, []).append((created, self._epoch, node))
+        self._page_epochs[page_num] = self._epoch
+        return True
+
+    def get_version(self, page_num: int, epoch: int) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
+        # the page as seen by the snapshot of epoch
+        if self._page_epochs.get(page_num, 0) <= epoch:
+            return self.load_page(page_num)
+        for created, superseded, node in self._versions[page_num]:
+            if created <= epoch < superseded:
+                return node
+        raise Exception(f"No version of page {page_num} for snapshot {epoch}")
+
+    def snapshot(self):
+        # While snapshots are live, get_page is replaced by get_page_cow on
+        # this pager, so that there is no cost when there are none. The tree
+        # takes the nodes it changes through get_page and only reads through
+        # load_page, so that only written pages are copied.
+        epoch = self._epoch
+        self._epoch += 1
+        self._snapshot_epochs[epoch] = self._snapshot_epochs.get(epoch, 0) + 1
+        self.get_page = self.get_page_cow
+        return SnapshotPager(self, epoch)
+
+    def release_snapshot(self, epoch: int):
+        # Drop a snapshot and reclaim the versions no live snapshot can see.
+        count = self._snapshot_epochs[epoch] - 1
+        if count > 0:
+            self._snapshot_epochs[epoch] = count
+            return
+        del self._snapshot_epochs[epoch]
+        if not self._snapshot_epochs:
+            del self.get_page
+        live = sorted(self._snapshot_epochs)
+        for page_num in list(self._versions):
+            versions = [(created, superseded, node)
+                        for created, superseded, node in self._versions[page_num]
+                        if any(created <= e < superseded for e in live)]
+            if versions:
+                self._versions[page_num] = versions
+            else:
+                del self._versions[page_num]
+
+    def get_num_versions(self):
+        return sum(len(versions) for versions in self._versions.values())
+
+    def get_num_pages(self):
+        return self._next_page - len(self._free_pages)
+
+    def get_page_counts(self):
+        # (hits, misses) of get_page; a miss reads or creates the node
+        return self._cache_hits, self._cache_misses
+
     def get_node_max_key(self, node: Union[BtreeNodeLeaf,BtreeNodeInternal]) -> int:
+        return node.get_max_key()
+
+class SnapshotPager(Pager):
+    # Read-only view of a pager as of a snapshot epoch.
+    def __init__(self, pager: Pager, epoch: int):
+        self._pager = pager
+        self._epoch = epoch
+
+    def get_epoch(self):
+        return self._epoch
+
+    def get_page_counts(self):
+        return self._pager.get_page_counts()
+
+    def get_page(self, page_num: int) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
+        return self._pager.get_version(page_num, self._epoch)
+
+    def has_page(self, page_num: int) -> bool:
+        return True
+
+    def get_unused_page_num(self):
+        raise Exception("Snapshots are read-only")
+
+    def set_page(self, page_num, node):
+        raise Exception("Snapshots are read-only")
+
+    def free_page(self, page_num: int):
+        raise Exception("Snapshots are read-only")
+
+    def release(self):
+        self._pager.release_snapshot(self._epoch)
+
+def serialize_row(val, buf, offset: int = 0):
+    # val is a row dict {"id", "user", "email"}; strings are NUL padded,
+    # and rejected if too long, as in db.c
+    buf[offset:offset + ROW.size] = ROW_LAYOUT.pack(val)
+
+def deserialize_row(buf, offset: int = 0):
+    return ROW_LAYOUT.unpack_from(buf, offset)
+
+def encode_key(key) -> bytes:
+    # Encode None, bool, int, float, str, bytes, uuid.UUID or a tuple of
+    # these as bytes that compare in the same order as the keys do (within
+    # one type; types sort by their KEY_* tag). Keys that compare equal get
+    # the same encoding: bools and integral floats are encoded as ints, and
+    # come back from decode_key as ints. Numbers of all types sort together.
+    # Every encoding is self delimiting, so tuples are their elements one
+    # after the other. Strings and bytes end in a NUL, with NULs inside
+    # escaped as NUL 0xff.
+    out = bytearray()
+    encode_key_into(key, out, False)
+    return bytes(out)
+
+def encode_key_into(key, out: bytearray, nested: bool):
+    if key is None:
+        out.extend(b"\x00\xff" if nested else b"\x00")
+    elif isinstance(key, int):
+        encode_int_into(key, out)
+    elif isinstance(key, float):
+        # A NaN key could never be found again, as it equals nothing. Other
+        # floats are their floor, an int, followed by KEY_FRACTION and the
+        # bits of the fraction if they are not integral; a float is a
+        # binary fraction, so this is exact.
+        if math.isnan(key):
+            raise Exception("Cannot encode a NaN key")
+        if math.isinf(key):
+            out.append(KEY_POS_INF if key > 0 else KEY_NEG_INF)
+            return
+        num, den = key.as_integer_ratio()
+        floor = num // den
+        encode_int_into(floor, out)
+        if den > 1:
+            # den is 2^bits; the fraction is padded to whole bytes, and its
+            # last byte is never 0
+            bits = den.bit_length() - 1
+            n = (bits + 7) // 8
+            fraction = ((num - floor * den) << (n * 8 - bits)).to_bytes(n, "big")
+            out.append(KEY_FRACTION)
+            out.extend(fraction.replace(b"\x00", b"\x00\xff"))
+            out.append(0x00)
+    elif isinstance(key, str):
+        out.append(KEY_STR)
+        out.extend(key.encode().replace(b"\x00", b"\x00\xff"))
+        out.append(0x00)
+    elif isinstance(key, (bytes, bytearray)):
+        out.append(KEY_BYTES)
+        out.extend(bytes(key).replace(b"\x00", b"\x00\xff"))
+        out.append(0x00)
+    elif isinstance(key, uuid.UUID):
+        out.append(KEY_UUID)
+        out.extend(key.bytes)
+    elif isinstance(key, tuple):
+        out.append(KEY_TUPLE)
+        for element in key:
+            encode_key_into(element, out, True)
+        out.append(0x00)
+    else:
+        raise Exception(f"Cannot encode a key of type {type(key).__name__}")
+
+def encode_int_into(key: int, out: bytearray):
+    if key == 0:
+        out.append(KEY_INT_ZERO)
+        return
+    magnitude = abs(key)
+    n = (magnitude.bit_length() + 7) // 8
+    data = magnitude.to_bytes(n, "big")
+    if key < 0:
+        # one's complement, so that larger magnitudes sort first
+        data = bytes(b ^ 0xff for b in data)
+    if n <= 8:
+        out.append(KEY_INT_ZERO + n if key > 0 else KEY_INT_ZERO - n)
+    elif n > 255:
+        raise Exception(f"Int key too large to encode: {key}")
+    elif key > 0:
+        out.extend((KEY_INT_POS_LONG, n))
+    else:
+        out.extend((KEY_INT_NEG_LONG, n ^ 0xff))
+    out.extend(data)
+
+def decode_key(data: bytes):
+    # Inverse of encode_key.
+    key, end = decode_key_from(data, 0, False)
+    if end != len(data):
+        raise Exception(f"Trailing bytes after key at {end}")
+    return key
+
+def decode_key_from(data: bytes, pos: int, nested: bool):
+    # Return the key encoded at pos and the position after it.
+    tag = data[pos]
+    pos += 1
+    if tag == KEY_NONE:
+        return None, pos + 1 if nested else pos
+    if tag == KEY_NEG_INF or tag == KEY_POS_INF:
+        return math.inf if tag == KEY_POS_INF else -math.inf, pos
+    if KEY_INT_NEG_LONG <= tag <= KEY_INT_POS_LONG:
+        if tag == KEY_INT_POS_LONG:
+            n = data[pos]
+            pos += 1
+        elif tag == KEY_INT_NEG_LONG:
+            n = data[pos] ^ 0xff
+            pos += 1
+        else:
+            n = abs(tag - KEY_INT_ZERO)
+        magnitude = data[pos:pos + n]
+        pos += n
+        if tag < KEY_INT_ZERO:
+            key = -int.from_bytes(bytes(b ^ 0xff for b in magnitude), "big")
+        else:
+            key = int.from_bytes(magnitude, "big")
+        if pos < len(data) and data[pos] == KEY_FRACTION:
+            # a float: its floor, then the fraction; int / int rounds
+            # correctly, so the float comes back exactly
+            fraction, pos = decode_escaped(data, pos + 1)
+            scale = 1 << (len(fraction) * 8)
+            return (key * scale + int.from_bytes(fraction, "big")) / scale, pos
+        return key, pos
+    if tag == KEY_STR or tag == KEY_BYTES:
+        raw, pos = decode_escaped(data, pos)
+        return raw.decode() if tag == KEY_STR else raw, pos
+    if tag == KEY_UUID:
+        return uuid.UUID(bytes=bytes(data[pos:pos + 16])), pos + 16
+    if tag == KEY_TUPLE:
+        elements = []
+        while data[pos] != 0x00 or (pos + 1 < len(data) and data[pos + 1] == 0xff):
+            element, pos = decode_key_from(data, pos, True)
+            elements.append(element)
+        return tuple(elements), pos + 1
+    raise Exception(f"Unknown key tag {tag:#x} at {pos - 1}")
+
+def decode_escaped(data: bytes, pos: int):
+    # Return the NUL terminated bytes at pos with NUL 0xff unescaped, and
+    # the position after the terminator.
+    end = pos
+    while True:
+        end = data.index(b"\x00", end)
+        if end + 1 < len(data) and data[end + 1] == 0xff:
+            end += 2
+            continue
+        break
+    return bytes(data[pos:end]).replace(b"\x00\xff", b"\x00"), end + 1
+
+def key_prefix_range(prefix: tuple):
+    # (lo, hi) of the encoded tuple keys that start with the elements of
+    # prefix, for scan(lo, hi).
+    lo = encode_key(prefix)[:-1]
+    return lo, lo + b"\xff"
+
+class FilePager(Pager):
+    # Pager backed by a file of PAGE_SIZE pages in the layout of db.c.
+    # Pages are read and deserialized on the first get_page or load_page.
+    # Pages taken for writing (get_page, set_page, get_unused_page_num,
+    # free_page) since the last write are kept in a dirty set; flush
+    # serializes those only, and writes back the ones that differ from the
+    # image last read from or written to the file. Keys
+    # must fit in a u32 and values must be rows. Released pages are written
+    # as a chain of NODE_FREE pages, each pointing to the one handed out
+    # after it, with the first one in the FILE_TRAILER of page 0. The chain
+    # is read back on open.
+    def __init__(self, filename: str):
+        super().__init__()
+        self._file = open(filename, "r+b" if os.path.exists(filename) else "w+b")
+        file_length = self._file.seek(0, os.SEEK_END)
+        if file_length % PAGE_SIZE != 0:
+            raise Exception("Db file is not a whole number of pages. Corrupt file.")
+        self._file_num_pages = file_length // PAGE_SIZE
+        self._next_page = max(self._file_num_pages, 1)
+        # the file position is shared, so each seek goes with its read or write
+        self._io_lock = threading.Lock()
+        # page images as last read from or written to the file
+        self._images = {}
+        self._dirty = set()
+        self._wal_attached = False
+        # whether the file was written by db.c (see FILE_TRAILER)
+        self._foreign = False
+        if self._file_num_pages > 0:
+            self.read_trailer()
+
+    def read_trailer(self):
+        # Check FILE_MAGIC and follow the chain of free pages from page 0
+        # into _free_pages, whose last page is handed out first.
+        for page_num in self._free_pages:
+            self._images.pop(page_num, None)
+        trailer = bytearray(FILE_TRAILER.size)
+        with self._io_lock:
+            self._file.seek(FILE_TRAILER_OFFSET)
+            self._file.readinto(trailer)
+        magic, page_num = FILE_TRAILER.unpack(trailer)
+        self._foreign = magic != FILE_MAGIC
+        if self._foreign:
+            page_num = 0
+        free_pages = []
+        seen = set()
+        while page_num != 0:
+            if page_num >= self._file_num_pages or page_num in seen:
+                raise Exception(f"Bad free page {page_num}. Corrupt file.")
+            page = self.read_page(page_num)
+            node_type, _, next_page_num = COMMON_NODE_HEADER.unpack_from(page, 0)
+            if node_type != NODE_FREE:
+                raise Exception(f"Free page {page_num} is in use. Corrupt file.")
+            self._images[page_num] = bytes(page)
+            free_pages.append(page_num)
+            seen.add(page_num)
+            page_num = next_page_num
+        self._free_pages = free_pages[::-1]
+
+    def get_free_list_head(self) -> int:
+        return self._free_pages[-1] if self._free_pages else 0
+
+    def is_foreign(self) -> bool:
+        return self._foreign
+
+    def set_foreign(self, foreign: bool):
+        self._foreign = foreign
+
+    def has_page(self, page_num: int) -> bool:
+        return page_num in self._node_map or page_num < self._file_num_pages
+
+    def get_unused_page_num(self):
+        # A reused or new page number must not be read back from the file.
+        # Page 0 is loaded, if evicted, to take the new free list head.
+        with self._lock:
+            page_num = super().get_unused_page_num()
+            self.load_page(0)
+            self._node_map[page_num] = self.new_leaf()
+            self._images.pop(page_num, None)
+            self._dirty.update((page_num, 0))
+            return page_num
+
+    def free_page(self, page_num: int):
+        with self._lock:
+            super().free_page(page_num)
+            self._images.pop(page_num, None)
+            self.load_page(0)
+            self._dirty.update((page_num, 0))
+
+    def get_page(self, page_num: int) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
+        # the page, to be written
+        node = self.fetch_page(page_num)
+        self._dirty.add(page_num)
+        return node
+
+    def load_page(self, page_num: int) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
+        # the page, to be read only
+        return self.fetch_page(page_num)
+
+    def get_page_cow(self, page_num: int) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
+        node = super().get_page_cow(page_num)
+        self._dirty.add(page_num)
+        return node
+
+    def store_page(self, page_num, node):
+        super().store_page(page_num, node)
+        self._dirty.add(page_num)
+
+    def fetch_page(self, page_num: int) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
+        # cache-hit
+        if page_num in self._node_map:
+            self._cache_hits += 1
+            return self._node_map[page_num]
+
+        # cache-miss
+        if page_num >= self._file_num_pages:
+            return super().get_page(page_num)
+        self._cache_misses += 1
+        page = self.read_page(page_num)
+        n = self.deserialize_node(memoryview(page))
+        # threads reading the same page at once all get the first node stored
+        with self._lock:
+            if page_num not in self._node_map:
+                self._images[page_num] = bytes(page)
+            return self._node_map.setdefault(page_num, n)
+
+    def read_page(self, page_num: int) -> bytearray:
+        page = bytearray(PAGE_SIZE)
+        with self._io_lock:
+            self._file.seek(page_num * PAGE_SIZE)
+            self._file.readinto(page)
+        return page
+
+    def write_page(self, page_num: int, page: bytearray):
+        with self._io_lock:
+            self._file.seek(page_num * PAGE_SIZE)
+            self._file.write(page)
+            self._file_num_pages = max(self._file_num_pages, page_num + 1)
+
+    def page_images(self):
+        # Yield (page_num, page) with the serialized image of every dirty
+        # free page, then of every dirty page in memory, that differs from
+        # its image. Page 0 comes last, so that its trailer reaches the file
+        # after the pages it describes. The page buffer is reused between
+        # pages.
+        yield from self.free_page_images()
+        page = bytearray(PAGE_SIZE)
+        for page_num in list(self._dirty):
+            node = self._node_map.get(page_num)
+            if page_num == 0 or node is None:
+                continue
+            self.serialize_page(page_num, node, page)
+            if self._images.get(page_num) != page:
+                yield page_num, page
+        if 0 in self._dirty and 0 in self._node_map:
+            self.serialize_page(0, self._node_map[0], page)
+            if self._images.get(0) != page:
+                yield 0, page
+
+    def free_page_images(self):
+        # Each free page points to the one below it in _free_pages, so only
+        # newly freed pages change.
+        page = bytearray(PAGE_SIZE)
+        next_page_num = 0
+        for page_num in self._free_pages:
+            if page_num in self._dirty:
+                page[:] = bytes(PAGE_SIZE)
+                COMMON_NODE_HEADER.pack_into(page, 0, NODE_FREE, False, next_page_num)
+                if self._images.get(page_num) != page:
+                    yield page_num, page
+            next_page_num = page_num
+
+    def serialize_page(self, page_num: int, node: Union[BtreeNodeLeaf,BtreeNodeInternal], page: bytearray):
+        self.serialize_node(node, page)
+        if page_num == 0:
+            FILE_TRAILER.pack_into(page, FILE_TRAILER_OFFSET, FILE_MAGIC, self.get_free_list_head())
+
+    def attach_wal(self):
+        # From now on pages reach the file only through Btree.checkpoint,
+        # which logs them first, so the file never holds a change that the
+        # log would replay again.
+        self._wal_attached = True
+
+    def flush(self):
+        if self._wal_attached:
+            raise Exception("A FilePager with a WAL is written by Btree.checkpoint only")
+        self.write_pages()
+
+    def write_pages(self):
+        for page_num, page in self.page_images():
+            self.write_page(page_num, page)
+            self._images[page_num] = bytes(page)
+        self._dirty.clear()
+        self._file.flush()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        # With a WAL, the changes since the last checkpoint are left to the
+        # log; Btree.close checkpoints them first.
+        if not self._wal_attached:
+            self.flush()
+        self._file.close()
+
+    @staticmethod
+    def serialize_node(node: Union[BtreeNodeLeaf,BtreeNodeInternal], page: bytearray):
+        page[:] = bytes(PAGE_SIZE)
         if isinstance(node, BtreeNodeLeaf):
-            return node.get_max_key_internal()
+            LEAF_NODE_HEADER.pack_into(page, 0, NODE_LEAF, node.is_root(), 0,
+                                       node.get_num_cells(), node.get_next_leaf_ptr())
+            offset = LEAF_NODE_HEADER.size
+            for cell_num in range(node.get_num_cells()):
+                key, val = node.get_cell(cell_num)
+                struct.pack_into("<I", page, offset, key)
+                serialize_row(val, page, offset + 4)
+                offset += LEAF_NODE_CELL.size
+        else:
+            right_child_ptr = node.get_right_child_ptr()
+            if right_child_ptr == INVALID_PAGE_NUM:
+                right_child_ptr = DISK_INVALID_PAGE_NUM
+            INTERNAL_NODE_HEADER.pack_into(page, 0, NODE_INTERNAL, node.is_root(), node.get_max_key(),
+                                           node.get_num_keys(), right_child_ptr)
+            offset = INTERNAL_NODE_HEADER.size
+            for cell_num in range(node.get_num_keys()):
+                INTERNAL_NODE_CELL.pack_into(page, offset, *node.get_cell(cell_num))
+                offset += INTERNAL_NODE_CELL.size
+
+    @staticmethod
+    def deserialize_node(page: memoryview) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
+        node_type, is_root, max_key = COMMON_NODE_HEADER.unpack_from(page, 0)
+        if node_type == NODE_LEAF:
+            _, _, _, num_cells, next_leaf_ptr = LEAF_NODE_HEADER.unpack_from(page, 0)
+            n = BtreeNodeLeaf(is_root=bool(is_root))
+            n.set_next_leaf_ptr(next_leaf_ptr)
+            start = LEAF_NODE_HEADER.size
+            cells = page[start:start + num_cells * LEAF_NODE_CELL.size]
+            keys = []
+            vals = []
+            for key, row in LEAF_NODE_CELL.iter_unpack(cells):
+                keys.append(key)
+                vals.append(deserialize_row(row))
+            n.extend_cells(keys, vals)
+        elif node_type == NODE_INTERNAL:
+            _, _, _, num_keys, right_child_ptr = INTERNAL_NODE_HEADER.unpack_from(page, 0)
+            if right_child_ptr == DISK_INVALID_PAGE_NUM:
+                right_child_ptr = INVALID_PAGE_NUM
+            n = BtreeNodeInternal(is_root=bool(is_root))
+            start = INTERNAL_NODE_HEADER.size
+            cells = page[start:start + num_keys * INTERNAL_NODE_CELL.size]
+            child_ptrs = []
+            keys = []
+            for child_ptr, key in INTERNAL_NODE_CELL.iter_unpack(cells):
+                child_ptrs.append(child_ptr)
+                keys.append(key)
+            n.set_cells(child_ptrs, keys, right_child_ptr)
+            n.set_max_key(max_key)
+        else:
+            raise Exception(f"Unknown node type {node_type}")
+        return n
+
+class BufferPool(FilePager):
+    # FilePager that keeps at most max_pages nodes in memory, evicting the
+    # least recently used one when a page is added over the limit. Dirty
+    # pages are written back on eviction or flush. Pages pinned with pin()
+    # are never evicted. Between
+    # begin_operation and end_operation, every page a thread gets or adds is
+    # pinned until the operation ends, so that a Btree insert, delete or
+    # split never changes a node that has already been written back. If
+    # every page is pinned, the pool goes over its budget until pages are
+    # let go. The pool can be shared by threads; file reads are done outside
+    # its lock.
+    def __init__(self, filename: str, max_pages: int = 400):
+        super().__init__(filename)
+        if max_pages < 1:
+            raise Exception(f"max_pages must be at least 1, got {max_pages}")
+        self._max_pages = max_pages
+        self._node_map = OrderedDict() # least recently used first
+        self._pin_counts = {}
+        # per thread: the depth of nested operations and the pages they pinned
+        self._operation = threading.local()
+        # counts
+        self._page_reads = 0
+        self._page_writes = 0
+        self._evictions = 0
+
+    def print_cache_counts(self):
+        print(f"Cache hits: {self._cache_hits}")
+        print(f"Cache misses: {self._cache_misses}")
+        print(f"Cache hit ratio: {self.get_hit_ratio():.4f}")
+        print(f"Page reads: {self._page_reads}")
+        print(f"Page writes: {self._page_writes}")
+        print(f"Evictions: {self._evictions}")
+
+    def get_hit_ratio(self) -> float:
+        num_gets = self._cache_hits + self._cache_misses
+        return self._cache_hits / num_gets if num_gets > 0 else 0.0
+
+    def pin(self, page_num: int):
+        self._pin_counts[page_num] = self._pin_counts.get(page_num, 0) + 1
+
+    def unpin(self, page_num: int):
+        pin_count = self._pin_counts[page_num] - 1
+        if pin_count == 0:
+            del self._pin_counts[page_num]
+        else:
+            self._pin_counts[page_num] = pin_count
+
+    def begin_operation(self):
+        # Operations nest; the pages are let go when the outermost one ends.
+        operation = self._operation
+        if getattr(operation, "depth", 0) == 0:
+            operation.depth = 0
+            operation.pages = set()
+        operation.depth += 1
+
+    def end_operation(self):
+        operation = self._operation
+        operation.depth -= 1
+        if operation.depth > 0:
+            return
+        with self._lock:
+            for page_num in operation.pages:
+                self.unpin(page_num)
+            operation.pages = None
+            self.evict()
+
+    def hold(self, page_num: int):
+        # Pin page_num until the running operation of this thread ends, if
+        # there is one. Called with the lock held.
+        pages = getattr(self._operation, "pages", None)
+        if pages is not None and page_num not in pages:
+            pages.add(page_num)
+            self.pin(page_num)
 
-        # need to traverse down RHS of tree for internal nodes
-        right_child = self.get_page(node.get_right_child_ptr())
-        return self.get_node_max_key(right_child)
+    def get_unused_page_num(self):
+        with self._lock:
+            page_num = super().get_unused_page_num()
+            self.hold(page_num)
+            self.evict()
+            return page_num
+
+    def fetch_page(self, page_num: int) -> Union[BtreeNodeLeaf,BtreeNodeInternal]:
+        with self._lock:
+            # cache-hit
+            if page_num in self._node_map:
+                self._cache_hits += 1
+                self._node_map.move_to_end(page_num)
+                self.hold(page_num)
+                return self._node_map[page_num]
+            self._cache_misses += 1
+
+        # cache-miss, the page is read without holding the pool
+        page = None
+        if page_num >= self._file_num_pages:
+            n = self.new_leaf()
+        else:
+            page = self.read_page(page_num)
+            n = self.deserialize_node(memoryview(page))
+        with self._lock:
+            if page_num in self._node_map:
+                # another thread read it in the meantime
+                self._node_map.move_to_end(page_num)
+                self.hold(page_num)
+                return self._node_map[page_num]
+            if page is not None:
+                self._page_reads += 1
+                self._images[page_num] = bytes(page)
+            self._node_map[page_num] = n
+            self.hold(page_num)
+            self.evict()
+            return n
+
+    def store_page(self, page_num, node):
+        with self._lock:
+            self._node_map[page_num] = node
+            self._node_map.move_to_end(page_num)
+            self._dirty.add(page_num)
+            self.hold(page_num)
+            self.evict()
+
+    def evict(self):
+        excess = len(self._node_map) - self._max_pages
+        if excess <= 0:
+            return
+        victims = []
+        for page_num in self._node_map:
+            if len(victims) == excess:
+                break
+            if page_num in self._pin_counts:
+                continue
+            victims.append(page_num)
+        page = bytearray(PAGE_SIZE)
+        for page_num in victims:
+            self.write_back(page_num, page)
+            del self._node_map[page_num]
+            self._images.pop(page_num, None)
+            self._dirty.discard(page_num)
+            self._evictions += 1
+
+    def write_back(self, page_num: int, page: bytearray):
+        # write the page to the file if it is dirty
+        self.serialize_page(page_num, self._node_map[page_num], page)
+        if self._images.get(page_num) != page:
+            self.write_page(page_num, page)
+            self._page_writes += 1
+            self._images[page_num] = bytes(page)
+
+    def flush(self):
+        # page 0 last, as in page_images
+        with self._lock:
+            for page_num, page in self.free_page_images():
+                self.write_page(page_num, page)
+                self._page_writes += 1
+                self._images[page_num] = bytes(page)
+            page = bytearray(PAGE_SIZE)
+            for page_num in self._node_map:
+                if page_num != 0:
+                    self.write_back(page_num, page)
+            if 0 in self._node_map:
+                self.write_back(0, page)
+            self._dirty.clear()
+            self._file.flush()
+
+class WriteAheadLog:
+    # Append-only log of inserts and deletes (rows in the Row layout) and of
+    # checkpoints. Records are written as they come, and fsynced together
+    # once commit_interval seconds have passed since the last fsync (group
+    # commit), so many consecutive operations share one fsync. The fsync
+    # comes with the first record after the interval, or from a timer if no
+    # record follows, so no record waits much longer than commit_interval.
+    # An interval of 0 fsyncs every record; commit() forces an fsync at any
+    # time. A record is durable once it is committed.
+    def __init__(self, filename: str, commit_interval: float = 0.01):
+        self._file = open(filename, "a+b")
+        self._commit_interval = commit_interval
+        self._last_commit = time.monotonic()
+        self._num_pending = 0
+        # the timer commits from its own thread
+        self._lock = threading.Lock()
+        self._timer = None
+        # counts
+        self._record_cnt = 0
+        self._commit_cnt = 0
+
+    def print_commit_counts(self):
+        print(f"WAL records: {self._record_cnt}")
+        print(f"WAL commits (fsync): {self._commit_cnt}")
+
+    def append(self, op: int, key: int, payload: bytes = b""):
+        header = WAL_RECORD_HEADER.pack(op, key, len(payload))
+        crc = zlib.crc32(payload, zlib.crc32(header))
+        with self._lock:
+            self._file.write(header)
+            self._file.write(payload)
+            self._file.write(WAL_RECORD_CRC.pack(crc))
+            self._record_cnt += 1
+            self._num_pending += 1
+            wait = self._last_commit + self._commit_interval - time.monotonic()
+            if wait <= 0:
+                self.commit_pending()
+            elif self._timer is None:
+                self._timer = threading.Timer(wait, self.commit)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def log_insert(self, key: int, val):
+        row = bytearray(ROW.size)
+        serialize_row(val, row)
+        self.append(WAL_INSERT, key, row)
+
+    def log_delete(self, key: int):
+        self.append(WAL_DELETE, key)
+
+    def commit(self):
+        with self._lock:
+            self.commit_pending()
+
+    def commit_pending(self):
+        # commit, with the lock held
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._num_pending > 0:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._commit_cnt += 1
+            self._num_pending = 0
+        self._last_commit = time.monotonic()
+
+    def records(self):
+        # Yield (op, key, payload) for every complete record. A torn or
+        # corrupt record at the end (from a crash mid-write) ends the log.
+        with self._lock:
+            self._file.flush()
+            self._file.seek(0)
+            data = self._file.read()
+        offset = 0
+        while offset + WAL_RECORD_HEADER.size <= len(data):
+            op, key, length = WAL_RECORD_HEADER.unpack_from(data, offset)
+            end = offset + WAL_RECORD_HEADER.size + length
+            if end + WAL_RECORD_CRC.size > len(data):
+                break
+            (crc,) = WAL_RECORD_CRC.unpack_from(data, end)
+            if crc != zlib.crc32(data[offset:end]):
+                break
+            yield op, key, data[offset + WAL_RECORD_HEADER.size:end]
+            offset = end + WAL_RECORD_CRC.size
+
+    def truncate(self):
+        with self._lock:
+            self._file.truncate(0)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._num_pending = 0
+
+    def close(self):
+        self.commit()
+        self._file.close()
 
 class Cursor:
     def __init__(self, btree, page_num):
@@ -205,6 +1536,9 @@ class Cursor:
         self._page_num = page_num
         self._cell_num = 0
         self._end_of_table = False
+        # (page_num, child_index) of each internal node on the way down
+        # from the root, used to propagate splits back up the tree
+        self._path = []
 
     def get_page_num(self):
         return self._page_num
@@ -218,6 +1552,12 @@ class Cursor:
     def set_cell_num(self, cell_num: int):
         self._cell_num = cell_num
 
+    def get_path(self):
+        return self._path
+
+    def set_path(self, path):
+        self._path = path
+
     def is_end_of_table(self):
         return self._end_of_table
 
@@ -225,12 +1565,11 @@ class Cursor:
         self._end_of_table = end_of_table
 
     def value(self):
-        node: BtreeNodeLeaf = self._btree._pager.get_page(self._page_num)
-        _, v = node.get_cell(cell_num=self._cell_num)
-        return v
+        node: BtreeNodeLeaf = self._btree._pager.load_page(self._page_num)
+        return node.get_value(self._cell_num)
 
     def advance(self):
-        node: BtreeNodeLeaf = self._btree._pager.get_page(self._page_num)
+        node: BtreeNodeLeaf = self._btree._pager.load_page(self._page_num)
         self._cell_num += 1
 
         # Advance to next leaf node
@@ -247,20 +1586,18 @@ class Cursor:
     def leaf_node_insert(self, key: int, val) -> None:
         node: BtreeNodeLeaf = self._btree._pager.get_page(self._page_num)
         num_cells = node.get_num_cells()
+        self._btree._split_policy.record_insert(self._page_num, self._cell_num, num_cells)
+
+        if self._cell_num == num_cells:
+            # key is the new max of this leaf, and possibly of its ancestors
+            self._btree.update_max_key(self._path, key)
 
-        if num_cells >= LEAF_NODE_MAX_CELLS:
+        if num_cells >= self._btree._leaf_max_cells:
             # Node full
             self.leaf_node_split_and_insert(key, val)
             return
 
-        # make room for new cell
-        if self._cell_num < num_cells:
-            for i in range(num_cells, self._cell_num, -1):
-                node.set_cell(i, node.get_cell(i - 1))
-
-        # set new cell value
-        node.set_cell(self._cell_num, (key, val))
-        node.set_num_cells(num_cells + 1)
+        node.insert_cell(self._cell_num, key, val)
 
     def leaf_node_split_and_insert(self, key: int, val):
         self._btree._split_cnt_leaf_node += 1
@@ -269,10 +1606,8 @@ class Cursor:
         #  Update parent or create a new parent.
 
         old_node: BtreeNodeLeaf = self._btree._pager.get_page(self._page_num)
-        old_max = self._btree._pager.get_node_max_key(old_node)
         new_page_num: int = self._btree._pager.get_unused_page_num()
         new_node: BtreeNodeLeaf = self._btree._pager.get_page(new_page_num)
-        new_node.set_parent_ptr(old_node.get_parent_ptr())
 
         # Whenever we split a leaf node, update the sibling pointers. 
         # The old leaf’s sibling becomes the new leaf, and the new leaf’s 
@@ -280,90 +1615,951 @@ class Cursor:
         new_node.set_next_leaf_ptr(old_node.get_next_leaf_ptr())
         old_node.set_next_leaf_ptr(new_page_num)
 
-        #  All existing keys plus new key should be divided
-        #  evenly between old (left) and new (right) nodes.
-        #  Starting from the right, move each key to correct position.
-
-        for i in range(LEAF_NODE_MAX_CELLS, -1, -1):
-            destination_node = new_node if i >= LEAF_NODE_LEFT_SPLIT_COUNT else old_node
-            index_within_node = i % LEAF_NODE_LEFT_SPLIT_COUNT
-
-            if i == self._cell_num:
-                destination_node.set_cell(cell_num=index_within_node, cell=(key, val))
-
-            elif i > self._cell_num:
-                destination_node.set_cell(cell_num=index_within_node, cell=old_node.get_cell(i - 1))
-            else:
-                destination_node.set_cell(cell_num=index_within_node, cell=old_node.get_cell(i))
-
-            # update cell counts
-            old_node.set_num_cells(LEAF_NODE_LEFT_SPLIT_COUNT)
-            new_node.set_num_cells(LEAF_NODE_RIGHT_SPLIT_COUNT)
+        #  All existing keys plus new key are divided between old (left)
+        #  and new (right) nodes as decided by the tree's split policy.
+        #  Insert the new cell, then move the upper cells over in one slice.
+        old_node.insert_cell(self._cell_num, key, val)
+        left_count = self._btree._split_policy.split_point(
+            old_node.get_num_cells(), self._cell_num, new_node.get_next_leaf_ptr() == 0, True)
+        new_node.extend_cells(*old_node.truncate_cells(left_count))
 
         if old_node.is_root():
             return self._btree.create_new_root(right_child_page_num=new_page_num)
         else:
-            parent_page_num = old_node.get_parent_ptr()
-            new_max = self._btree._pager.get_node_max_key(old_node)
-            parent: BtreeNodeInternal = self._btree._pager.get_page(parent_page_num)
-            parent.update_key(old_max, new_max)
-
-            self._btree.internal_node_insert(parent_page_num, new_page_num)
+            # the old node keeps its place in the parent with its new max key
+            # as separator, the new node is inserted to its right
+            depth = len(self._path) - 1
+            self._btree.internal_node_insert(self._path, depth, old_node.get_max_key(), new_page_num)
             return 
 
+def pager_operation(method):
+    # Run a Btree method that changes nodes between begin_operation and
+    # end_operation of its pager, so that a BufferPool keeps every node the
+    # method touches in memory until it returns.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._pager.begin_operation()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._pager.end_operation()
+    return wrapper
+
 class Btree:
-    def __init__(self):
-        self._pager = Pager()
+    def __init__(self, split_policy: SplitPolicy = None, pager: Pager = None,
+                 wal: WriteAheadLog = None, leaf_capacity: int = None,
+                 internal_capacity: int = None):
+        self._pager = pager if pager is not None else Pager()
+        # Node capacities, in cells of a leaf and keys of an internal node.
+        # They default to LEAF_NODE_MAX_CELLS and INTERNAL_NODE_MAX_CELLS,
+        # and nodes below half of them are rebalanced on delete.
+        self._leaf_max_cells = leaf_capacity if leaf_capacity is not None else LEAF_NODE_MAX_CELLS
+        self._internal_max_cells = internal_capacity if internal_capacity is not None else INTERNAL_NODE_MAX_CELLS
+        if self._leaf_max_cells < 2 or self._internal_max_cells < 2:
+            raise Exception(f"Node capacities must be at least 2, got {self._leaf_max_cells} "
+                            f"and {self._internal_max_cells}")
+        if isinstance(self._pager, FilePager) and (self._leaf_max_cells > LEAF_NODE_PAGE_MAX_CELLS or
+                                                   self._internal_max_cells > INTERNAL_NODE_MAX_KEYS):
+            raise Exception(f"Nodes of a FilePager hold at most {LEAF_NODE_PAGE_MAX_CELLS} leaf cells "
+                            f"and {INTERNAL_NODE_MAX_KEYS} internal keys")
+        self._leaf_min_cells = self._leaf_max_cells // 2
+        self._internal_min_cells = self._internal_max_cells // 2
+        # the WAL relies on pages reaching the file only at checkpoints,
+        # which rules out in-memory pagers and BufferPool evictions
+        if wal is not None and type(self._pager) is not FilePager:
+            raise Exception("A WAL needs a FilePager")
+        self._wal = None
         self._root_page_num = 0
+        self._split_policy = split_policy if split_policy is not None else EvenSplitPolicy()
         # split counts
         self._split_cnt_internal_node = 0
         self._split_cnt_leaf_node = 0
         self._split_cnt_root = 0
-        # init root node (leaf node)
-        root_node = BtreeNodeLeaf(is_root=True)
-        self._pager.set_page(self._root_page_num, root_node)
+        # merge counts
+        self._merge_cnt_internal_node = 0
+        self._merge_cnt_leaf_node = 0
+        self._merge_cnt_root = 0
+        # Rightmost leaf and the path down to it, cached for inserts of keys
+        # beyond the current max. Cleared whenever an internal node changes.
+        self._rightmost_page_num = None
+        self._rightmost_path = []
+        # insert counts
+        self._insert_cnt = 0
+        self._insert_cnt_fast_path = 0
+        # where an incremental compact carries on from (None: the first leaf)
+        self._compact_key = None
+        # secondary indexes, field -> Btree (see create_index)
+        self._indexes = {}
+        # redo an interrupted checkpoint before the root page is looked at
+        records = list(wal.records()) if wal is not None else []
+        records = self.recover_checkpoint(records)
+        if isinstance(self._pager, FilePager) and self._pager.is_foreign():
+            self.rebuild_max_keys()
+        # init root node (leaf node), unless the pager already has a tree
+        if not self._pager.has_page(self._root_page_num):
+            root_node = self._pager.new_leaf(is_root=True)
+            self._pager.set_page(self._root_page_num, root_node)
+        # replay the operations logged since the last checkpoint
+        for op, key, payload in records:
+            if op == WAL_INSERT:
+                self.execute_insert(key, deserialize_row(payload))
+            elif op == WAL_DELETE:
+                self.execute_delete(key)
+        self._wal = wal
+        if wal is not None:
+            self._pager.attach_wal()
+            # start from a clean log, dropping any torn record at its end
+            self.checkpoint()
+
+    def get_capacities(self):
+        # (leaf_capacity, internal_capacity)
+        return self._leaf_max_cells, self._internal_max_cells
 
     def print_split_counts(self):
         print(f"Split count (internal node): {self._split_cnt_internal_node}")
         print(f"Split count (leaf node): {self._split_cnt_leaf_node}")
         print(f"Split count (root): {self._split_cnt_root}")
 
+    def snapshot(self):
+        # Return a read-only view of the tree as it is now, in O(1). Later
+        # writes copy the pages they change; release the snapshot so that
+        # the old versions can be reclaimed.
+        return BtreeSnapshot(self._pager.snapshot(), self._split_policy, *self.get_capacities())
+
+    def recover_checkpoint(self, records):
+        # If the log holds a complete checkpoint, write its page images to
+        # the pager's file (the crash may have come while the pages were
+        # being written). Return the records logged after it.
+        checkpoint_end = None
+        for i, (op, _, _) in enumerate(records):
+            if op == WAL_CHECKPOINT_END:
+                checkpoint_end = i
+        if checkpoint_end is None:
+            return records
+
+        for op, page_num, payload in records[:checkpoint_end]:
+            if op == WAL_PAGE:
+                self._pager.write_page(page_num, payload)
+        self._pager.sync()
+        self._pager.read_trailer()
+        return records[checkpoint_end + 1:]
+
+    def rebuild_max_keys(self):
+        # Internal nodes of a file written by db.c hold their parent page in
+        # the max key slot. Set the max key of each from its right child,
+        # bottom up. The nodes become dirty, and the next flush or
+        # checkpoint writes the file in this pager's format.
+        # (page_num, is_right_child, children pushed)
+        max_keys = {}
+        stack = [(self._root_page_num, False, False)]
+        while stack:
+            page_num, is_right_child, pushed = stack.pop()
+            node = self._pager.load_page(page_num)
+            if isinstance(node, BtreeNodeInternal):
+                if not pushed:
+                    stack.append((page_num, is_right_child, True))
+                    stack.append((node.get_right_child_ptr(), True, False))
+                    stack.extend((node.get_child_ptr(i), False, False) for i in range(node.get_num_keys()))
+                    continue
+                node = self._pager.get_page(page_num)
+                node.set_max_key(max_keys.pop(node.get_right_child_ptr()))
+            if is_right_child:
+                max_keys[page_num] = node.get_max_key()
+        self._pager.set_foreign(False)
+
+    def checkpoint(self):
+        # Make all changes durable in the pager's file and empty the log.
+        # The page images go to the log first, so a crash while the file is
+        # being written is repaired on the next open.
+        if self._wal is None:
+            self._pager.flush()
+            return
+        for page_num, page in self._pager.page_images():
+            self._wal.append(WAL_PAGE, page_num, page)
+        self._wal.append(WAL_CHECKPOINT_END, 0)
+        self._wal.commit()
+        self._pager.write_pages()
+        self._pager.sync()
+        self._wal.truncate()
+
+    def close(self):
+        # Checkpoint, then close the pager's file and the WAL, so that the
+        # next open has nothing to replay. In-memory pagers have no file.
+        if not isinstance(self._pager, FilePager):
+            return
+        self.checkpoint()
+        self._pager.close()
+        if self._wal is not None:
+            self._wal.close()
+
+    def commit(self):
+        # fsync everything logged so far
+        if self._wal is not None:
+            self._wal.commit()
+
+    def print_merge_counts(self):
+        print(f"Merge count (internal node): {self._merge_cnt_internal_node}")
+        print(f"Merge count (leaf node): {self._merge_cnt_leaf_node}")
+        print(f"Merge count (root): {self._merge_cnt_root}")
+
+    def print_insert_counts(self):
+        print(f"Insert count: {self._insert_cnt}")
+        print(f"Insert count (fast path): {self._insert_cnt_fast_path}")
+
+    def stats(self):
+        # Counters and occupancy of the tree as a dict, for export to a
+        # metrics system. Levels are numbered from the root (0) down to the
+        # leaves. A node's fill factor is its cells (children of internal
+        # nodes) over its capacity, and fill_histogram[i] counts the nodes
+        # with a fill factor in [i / FILL_HISTOGRAM_BINS, (i + 1) /
+        # FILL_HISTOGRAM_BINS), a full node counting in the last bin.
+        # comparisons_per_lookup is the number of key comparisons of the
+        # binary searches down to a key, averaged over the keys. The tree is
+        # walked depth-first with an explicit stack, one node at a time; the
+        # get_page counts are taken before the walk.
+        cache_hits, cache_misses = self._pager.get_page_counts()
+        levels = []
+        num_keys = 0
+        num_comparisons = 0
+        # (page_num, level, comparisons of the search down to the node)
+        stack = [(self._root_page_num, 0, 0)]
+        while stack:
+            page_num, level, comparisons = stack.pop()
+            node = self._pager.load_page(page_num)
+            if level == len(levels):
+                levels.append({"level": level, "num_nodes": 0, "num_cells": 0,
+                               "fill_histogram": [0] * FILL_HISTOGRAM_BINS})
+            stats = levels[level]
+            if isinstance(node, BtreeNodeLeaf):
+                num_cells = node.get_num_cells()
+                capacity = self._leaf_max_cells
+                num_keys += num_cells
+                # bisect over n cells takes up to n.bit_length() comparisons
+                num_comparisons += num_cells * (comparisons + num_cells.bit_length())
+            else:
+                num_cells = node.get_num_keys() + 1
+                capacity = self._internal_max_cells + 1
+                comparisons += node.get_num_keys().bit_length()
+                stack.append((node.get_right_child_ptr(), level + 1, comparisons))
+                for child_num in reversed(range(node.get_num_keys())):
+                    stack.append((node.get_child_ptr(child_num), level + 1, comparisons))
+            stats["num_nodes"] += 1
+            stats["num_cells"] += num_cells
+            fill_bin = min(num_cells * FILL_HISTOGRAM_BINS // capacity, FILL_HISTOGRAM_BINS - 1)
+            stats["fill_histogram"][fill_bin] += 1
+
+        for level, stats in enumerate(levels):
+            capacity = self._leaf_max_cells if level == len(levels) - 1 else self._internal_max_cells + 1
+            stats["fill_factor"] = stats["num_cells"] / (stats["num_nodes"] * capacity)
+
+        return {"height": len(levels),
+                "num_keys": num_keys,
+                "num_nodes": sum(stats["num_nodes"] for stats in levels),
+                "levels": levels,
+                "comparisons_per_lookup": num_comparisons / num_keys if num_keys > 0 else 0.0,
+                "get_page_calls": cache_hits + cache_misses,
+                "cache_hits": cache_hits,
+                "cache_misses": cache_misses,
+                "split_counts": {"internal_node": self._split_cnt_internal_node,
+                                 "leaf_node": self._split_cnt_leaf_node,
+                                 "root": self._split_cnt_root},
+                "merge_counts": {"internal_node": self._merge_cnt_internal_node,
+                                 "leaf_node": self._merge_cnt_leaf_node,
+                                 "root": self._merge_cnt_root},
+                "insert_counts": {"total": self._insert_cnt,
+                                  "fast_path": self._insert_cnt_fast_path}}
+
     def get_cursor(self, page_num) -> Cursor:
         return Cursor(btree=self, page_num=page_num)
 
     def get_start(self) -> Cursor:
-        cursor = self.table_find(0)
-        node = self._pager.get_page(cursor.get_page_num())
+        # the leftmost leaf, found without comparing keys so that any key
+        # type works
+        page_num = self._root_page_num
+        node = self._pager.load_page(page_num)
+        while isinstance(node, BtreeNodeInternal):
+            page_num = node.get_child_ptr(0)
+            node = self._pager.load_page(page_num)
+        cursor = self.get_cursor(page_num)
         num_cells = node.get_num_cells()
         cursor.set_end_of_table(num_cells == 0)
         return cursor
 
+    @pager_operation
     def execute_insert(self, key: int, val):
-
-        # get root node
-        node = self._pager.get_page(self._root_page_num)
-        num_cells = node.get_num_cells()
+        self.check_cell(key, val)
+        # index keys are encoded up front, so that a row that cannot be
+        # indexed is rejected before the tree changes
+        index_keys = self.index_keys(key, val) if self._indexes else None
+        self._insert_cnt += 1
+
+        # fast path: a key beyond the current max is appended to the cached
+        # rightmost leaf without descending the tree
+        if self._rightmost_page_num is not None:
+            node = self._pager.load_page(self._rightmost_page_num)
+            num_cells = node.get_num_cells()
+            # an empty leaf has no max key to compare with, so it takes the
+            # normal path
+            if num_cells > 0 and key > node.get_key(num_cells - 1):
+                self._insert_cnt_fast_path += 1
+                cursor = self.get_cursor(self._rightmost_page_num)
+                cursor.set_cell_num(num_cells)
+                cursor.set_path(self._rightmost_path)
+                cursor.leaf_node_insert(key, val)
+                if self._wal is not None:
+                    self._wal.log_insert(key, val)
+                if self._indexes:
+                    self.index_insert(key, index_keys)
+                return
 
         # find cursor for insert location
         cursor = self.table_find(key)
+        node = self._pager.get_page(cursor.get_page_num())
 
         # check for duplicate key
-        if cursor.get_cell_num() < num_cells:
+        if cursor.get_cell_num() < node.get_num_cells():
             key_at_index = node.get_key(cell_num=cursor.get_cell_num())
             if key_at_index == key:
                 raise Exception(f"Cannot insert a duplicate key: {key}")
 
         # insert value at leaf node
+        split_cnt = self._split_cnt_leaf_node
         cursor.leaf_node_insert(key, val)
 
+        if split_cnt == self._split_cnt_leaf_node and node.get_next_leaf_ptr() == 0:
+            self._rightmost_page_num = cursor.get_page_num()
+            self._rightmost_path = cursor.get_path()
+
+        if self._wal is not None:
+            self._wal.log_insert(key, val)
+        if self._indexes:
+            self.index_insert(key, index_keys)
+
+    def check_cell(self, key, val):
+        # A FilePager stores u32 keys and rows in the Row layout. Reject a
+        # cell that does not fit before it goes into the tree, rather than
+        # at the next flush, with part of the pages written.
+        if isinstance(self._pager, FilePager):
+            if not isinstance(key, int) or not 0 <= key <= 0xFFFFFFFF:
+                raise Exception(f"Keys of a FilePager must fit in a u32, got {key!r}")
+            ROW_LAYOUT.pack(val)
+
+    @pager_operation
+    def execute_insert_many(self, pairs):
+        # Insert a batch of (key, val) pairs. The batch is sorted and
+        # validated as a whole first: duplicates within the batch, then
+        # against the tree, one leaf at a time. On a duplicate nothing is
+        # inserted. The tree is then walked once, left to right: all keys
+        # that fall into the same leaf are added to it together, and the
+        # next leaf is found from the path of the previous one instead of
+        # from the root.
+        pairs = sorted(pairs, key=itemgetter(0))
+        keys = [k for k, _ in pairs]
+        vals = [v for _, v in pairs]
+
+        for key, val in pairs:
+            self.check_cell(key, val)
+        index_keys = [self.index_keys(key, val) for key, val in pairs] if self._indexes else None
+        for i in range(1, len(keys)):
+            if keys[i - 1] == keys[i]:
+                raise Exception(f"Cannot insert a duplicate key: {keys[i]}")
+        for _, node, _, start, end in self.find_leaf_groups(keys):
+            duplicate = node.find_duplicate(keys[start:end])
+            if duplicate is not None:
+                raise Exception(f"Cannot insert a duplicate key: {duplicate}")
+
+        path = bounds = ()
+        i = 0
+        while i < len(keys):
+            page_num, _, path, bounds = self.find_leaf(keys[i], path, bounds)
+            node = self._pager.get_page(page_num)
+            end = self.leaf_group_end(keys, i, bounds)
+
+            self._insert_cnt += end - i
+            num_cells = node.get_num_cells()
+            if num_cells + end - i <= self._leaf_max_cells:
+                if num_cells == 0 or keys[end - 1] > node.get_max_key():
+                    self.update_max_key(path, keys[end - 1])
+                node.insert_cells(keys[i:end], vals[i:end])
+            elif end - i == 1:
+                # a single key that does not fit takes the normal split path
+                cursor = self.get_cursor(page_num)
+                cursor.set_cell_num(node.find_cell(keys[i]))
+                cursor.set_path(path)
+                cursor.leaf_node_insert(keys[i], vals[i])
+                path = bounds = ()
+            else:
+                self.leaf_node_split_many(node, path, keys[i:end], vals[i:end])
+                path = bounds = ()
+            if self._wal is not None:
+                for j in range(i, end):
+                    self._wal.log_insert(keys[j], vals[j])
+            if self._indexes:
+                for j in range(i, end):
+                    self.index_insert(keys[j], index_keys[j])
+            i = end
+
+    def leaf_node_split_many(self, node: BtreeNodeLeaf, path, keys, vals):
+        # Add sorted keys that do not fit into the leaf by splitting it into
+        # as few leaves as will hold its cells plus the new ones, spread
+        # evenly. New leaves are split off the end of the leaf right to left,
+        # each one a normal leaf split, so the split cascades up the tree at
+        # most once per new leaf.
+        if node.get_num_cells() == 0 or keys[-1] > node.get_max_key():
+            # key is the new max of this leaf, and possibly of its ancestors
+            self.update_max_key(path, keys[-1])
+        node.insert_cells(keys, vals)
+        first_key = node.get_key(0)
+        groups = self.bulk_load_groups(node.get_num_cells(), self._leaf_max_cells)
+
+        for start, _ in reversed(groups[1:]):
+            self._split_cnt_leaf_node += 1
+            new_page_num = self._pager.get_unused_page_num()
+            new_node: BtreeNodeLeaf = self._pager.get_page(new_page_num)
+            new_node.extend_cells(*node.truncate_cells(start))
+            new_node.set_next_leaf_ptr(node.get_next_leaf_ptr())
+            node.set_next_leaf_ptr(new_page_num)
+
+            split_cnt = self._split_cnt_internal_node + self._split_cnt_root
+            if len(path) == 0:
+                self.create_new_root(right_child_page_num=new_page_num)
+            else:
+                self.internal_node_insert(path, len(path) - 1, node.get_max_key(), new_page_num)
+            if split_cnt != self._split_cnt_internal_node + self._split_cnt_root:
+                # the leaf may have moved, find it and the path to it again
+                page_num, _, path, _ = self.find_leaf(first_key)
+                node = self._pager.get_page(page_num)
+
+    @pager_operation
+    def execute_delete(self, key):
+        page_num, _, path, _ = self.find_leaf(key)
+        node = self._pager.get_page(page_num)
+        cell_num = node.find_cell(key)
+        if cell_num == node.get_num_cells() or node.get_key(cell_num) != key:
+            raise Exception(f"Cannot delete a missing key: {key}")
+        self.leaf_node_delete(path, node, cell_num)
+
+    def leaf_node_delete(self, path, node: BtreeNodeLeaf, cell_num: int):
+        key = node.get_key(cell_num)
+        if self._indexes:
+            self.index_delete(self.index_keys(key, node.get_value(cell_num)))
+        node.delete_cell(cell_num)
+        if self._wal is not None:
+            self._wal.log_delete(key)
+        num_cells = node.get_num_cells()
+        if len(path) == 0:
+            if num_cells == 0:
+                self._rightmost_page_num = None
+            return
+
+        if 0 < num_cells == cell_num:
+            # key was the max of this leaf, and possibly of its ancestors
+            self.lower_max_key(path, node.get_max_key())
+        elif num_cells == 0 and path[-1][1] > 0:
+            # With capacities below 4 a leaf can run empty. It is merged
+            # into its left sibling next, so it takes over its max key.
+            parent: BtreeNodeInternal = self._pager.load_page(path[-1][0])
+            left = self._pager.load_page(parent.get_child_ptr(path[-1][1] - 1))
+            self.lower_max_key(path, left.get_max_key())
+        if num_cells < self._leaf_min_cells:
+            self.leaf_node_rebalance(path)
+
+    def lower_max_key(self, path, max_key: int):
+        # The max key of the leaf below path dropped to max_key. Nodes
+        # reached through right child pointers take it as their max key, up
+        # to the first ancestor that holds it as a separator.
+        for page_num, child_index in reversed(path):
+            node = self._pager.get_page(page_num)
+            if child_index != node.get_num_keys():
+                node.set_key(child_index, max_key)
+                break
+            node.set_max_key(max_key)
+
+    def leaf_node_rebalance(self, path):
+        #  The leaf below path is underfull. Move the cells of it and its
+        #  left sibling (right sibling for the first child) into the left
+        #  one. If they fit, the right leaf is released and removed from the
+        #  parent, otherwise the cells are divided evenly again.
+        self._rightmost_page_num = None
+        parent_page_num, child_index = path[-1]
+        parent: BtreeNodeInternal = self._pager.get_page(parent_page_num)
+        if parent.get_num_keys() == 0:
+            # Only child: the parent is underfull as well. Rebalance it
+            # first, which gives the leaf siblings or makes it the root,
+            # then go on from the leaf's new path. The parent's max key is
+            # the upper bound of the leaf, so it leads there.
+            page_num = parent.get_right_child_ptr()
+            node = self._pager.get_page(page_num)
+            bound = parent.get_max_key()
+            self.internal_node_rebalance(path, len(path) - 1)
+            if node.is_root():
+                return
+            path = self.find_path(page_num, bound)
+            parent_page_num, child_index = path[-1]
+            parent = self._pager.get_page(parent_page_num)
+
+        left_index = max(child_index - 1, 0)
+        left: BtreeNodeLeaf = self._pager.get_page(parent.get_child_ptr(left_index))
+        right_page_num = parent.get_child_ptr(left_index + 1)
+        right: BtreeNodeLeaf = self._pager.get_page(right_page_num)
+
+        left.extend_cells(*right.truncate_cells(0))
+        num_cells = left.get_num_cells()
+        if num_cells <= self._leaf_max_cells:
+            self._merge_cnt_leaf_node += 1
+            left.set_next_leaf_ptr(right.get_next_leaf_ptr())
+            self._pager.free_page(right_page_num)
+            parent.remove_child(left_index)
+            self.internal_node_rebalance(path, len(path) - 1)
+        else:
+            right.extend_cells(*left.truncate_cells(num_cells - num_cells // 2))
+            parent.set_key(left_index, left.get_max_key())
+
+    def internal_node_rebalance(self, path, depth: int):
+        #  The node at path[depth] lost a child. Underfull internal nodes
+        #  are merged with or rebalanced against a sibling like leaves, and
+        #  a root left with a single child is replaced by that child.
+        self._rightmost_page_num = None
+        page_num, _ = path[depth]
+        node: BtreeNodeInternal = self._pager.get_page(page_num)
+        if node.is_root():
+            if node.get_num_keys() == 0:
+                self.collapse_root()
+            return
+        if node.get_num_keys() >= self._internal_min_cells:
+            return
+
+        parent_page_num, child_index = path[depth - 1]
+        parent: BtreeNodeInternal = self._pager.get_page(parent_page_num)
+        if parent.get_num_keys() == 0:
+            # only child: rebalance the parent first, as for leaves
+            max_key = node.get_max_key()
+            self.internal_node_rebalance(path, depth - 1)
+            if node.is_root():
+                return
+            path = self.find_path(page_num, max_key)
+            depth = len(path)
+            path.append((page_num, node.find_child(max_key)))
+            parent_page_num, child_index = path[depth - 1]
+            parent = self._pager.get_page(parent_page_num)
+
+        left_index = max(child_index - 1, 0)
+        left: BtreeNodeInternal = self._pager.get_page(parent.get_child_ptr(left_index))
+        right_page_num = parent.get_child_ptr(left_index + 1)
+        right: BtreeNodeInternal = self._pager.get_page(right_page_num)
+
+        left.extend_cells(*right.take_cells(), right.get_max_key())
+        num_keys = left.get_num_keys()
+        if num_keys <= self._internal_max_cells:
+            self._merge_cnt_internal_node += 1
+            self._pager.free_page(right_page_num)
+            parent.remove_child(left_index)
+            self.internal_node_rebalance(path, depth - 1)
+        else:
+            num_children = num_keys + 1
+            split_index = num_children - num_children // 2 - 1
+            left_max_key = left.get_key(split_index)
+            right.set_cells(*left.truncate_cells(split_index))
+            right.set_max_key(left.get_max_key())
+            left.set_max_key(left_max_key)
+            parent.set_key(left_index, left_max_key)
+
+    def find_path(self, page_num: int, key):
+        # The path down to the node on page_num (not included), found by
+        # descending with key, which must lie in the node's key range.
+        path = []
+        node_page_num = self._root_page_num
+        while node_page_num != page_num:
+            node: BtreeNodeInternal = self._pager.load_page(node_page_num)
+            child_index = node.find_child(key)
+            path.append((node_page_num, child_index))
+            node_page_num = node.get_child_ptr(child_index)
+        return path
+
+    def collapse_root(self):
+        # The root has a single child left. The child is moved to the root
+        # page and its old page is released, so the tree loses a level.
+        self._merge_cnt_root += 1
+        self._rightmost_page_num = None
+        root: BtreeNodeInternal = self._pager.get_page(self._root_page_num)
+        child_page_num = root.get_right_child_ptr()
+        child = self._pager.get_page(child_page_num)
+        child.set_is_root(True)
+        self._pager.set_page(self._root_page_num, child)
+        self._pager.free_page(child_page_num)
+
+    def get(self, key, default=None):
+        # Return the value stored for key, or default if it is not in the tree.
+        cursor = self.table_find(key)
+        node: BtreeNodeLeaf = self._pager.load_page(cursor.get_page_num())
+        cell_num = cursor.get_cell_num()
+        if cell_num < node.get_num_cells() and node.get_key(cell_num) == key:
+            return node.get_value(cell_num)
+        return default
+
+    def get_field(self, key, field, default=None):
+        # Return val[field] of the value stored for key, or default if key
+        # is not in the tree. Packed leaves decode only that field.
+        cursor = self.table_find(key)
+        node: BtreeNodeLeaf = self._pager.load_page(cursor.get_page_num())
+        cell_num = cursor.get_cell_num()
+        if cell_num < node.get_num_cells() and node.get_key(cell_num) == key:
+            return node.get_field(cell_num, field)
+        return default
+
+    def get_many(self, keys, default=None):
+        # Return the values stored for keys, in the order given, with
+        # default for keys that are not in the tree. The keys are looked up
+        # in sorted order so that consecutive keys share the descent, and
+        # all keys that land in one leaf are found in a single pass over it.
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        sorted_keys = [keys[i] for i in order]
+
+        out = [default] * len(keys)
+        for _, node, _, start, end in self.find_leaf_groups(sorted_keys):
+            vals = node.find_values(sorted_keys[start:end], default)
+            for i, val in zip(order[start:end], vals):
+                out[i] = val
+        return out
+
     def execute_select(self):
-        cursor = self.get_start()
-        while not cursor.is_end_of_table():
-            print(cursor.value())
-            cursor.advance()
+        for _, val in self.scan():
+            print(val)
+
+    def scan(self, lo=None, hi=None):
+        # Yield (key, val) pairs with lo <= key <= hi in key order (either
+        # bound may be None). Seeks to lo once, then follows the leaf chain
+        # handing out a whole leaf at a time, and stops as soon as a key
+        # above hi is seen. The tree must not change while this is iterated.
+        for node, start, end in self.scan_leaves(lo, hi):
+            yield from node.get_cells(start, end)
+
+    def scan_field(self, field, lo=None, hi=None):
+        # As scan, yielding (key, val[field]) pairs. Packed leaves decode
+        # only that field.
+        for node, start, end in self.scan_leaves(lo, hi):
+            yield from node.get_field_cells(field, start, end)
+
+    def scan_leaves(self, lo=None, hi=None):
+        # Yield (node, start, end) for the leaves of scan, cells start to
+        # end of each holding its keys in [lo, hi].
+        if lo is None:
+            page_num = self._root_page_num
+            node = self._pager.load_page(page_num)
+            while isinstance(node, BtreeNodeInternal):
+                page_num = node.get_child_ptr(0)
+                node = self._pager.load_page(page_num)
+            cell_num = 0
+        else:
+            cursor = self.table_find(lo)
+            page_num = cursor.get_page_num()
+            cell_num = cursor.get_cell_num()
+
+        while True:
+            node: BtreeNodeLeaf = self._pager.load_page(page_num)
+            num_cells = node.get_num_cells()
+            end = num_cells if hi is None else node.find_cell_after(hi, cell_num)
+            yield node, cell_num, end
+            page_num = node.get_next_leaf_ptr()
+            if end < num_cells or page_num == 0:
+                return
+            cell_num = 0
+
+    def create_index(self, field):
+        # Index the rows by val[field]. The index is an in-memory Btree with
+        # keys encode_key((val[field], key)) and the primary keys as values,
+        # so rows with equal field values sort by primary key. It is bulk
+        # loaded from the rows in the tree, and kept up to date by every
+        # insert and delete from then on. Rows without the field are indexed
+        # under None. Indexes are not persisted; create them again after
+        # opening a tree from its file.
+        if field in self._indexes:
+            raise Exception(f"Index on {field} already exists")
+        index = Btree(leaf_capacity=self._leaf_max_cells, internal_capacity=self._internal_max_cells)
+        index.bulk_load(sorted((encode_key((val.get(field), key)), key) for key, val in self.scan()))
+        self._indexes[field] = index
+
+    def get_index(self, field) -> "Btree":
+        index = self._indexes.get(field)
+        if index is None:
+            raise Exception(f"No index on {field}")
+        return index
+
+    def index_keys(self, key, val):
+        # (index, index key) of the row in every index; raises if a field
+        # cannot be encoded
+        return [(index, encode_key((val.get(field), key))) for field, index in self._indexes.items()]
+
+    def index_insert(self, key, index_keys):
+        for index, index_key in index_keys:
+            index.execute_insert(index_key, key)
+
+    def index_delete(self, index_keys):
+        for index, index_key in index_keys:
+            index.execute_delete(index_key)
+
+    def lookup_by(self, field, value):
+        # (key, val) pairs of the rows with val[field] == value, in key
+        # order: one descent of the index and a get_many of the keys found.
+        lo, hi = key_prefix_range((value,))
+        keys = [key for _, key in self.get_index(field).scan(lo, hi)]
+        return list(zip(keys, self.get_many(keys)))
+
+    def scan_by(self, field, lo=None, hi=None):
+        # Yield (key, val) pairs with lo <= val[field] <= hi (either bound
+        # may be None) in field order, ties in key order. The rows are
+        # fetched from the tree SCAN_BATCH_CELLS keys at a time. Values of
+        # different types sort by type first, see encode_key. The tree must
+        # not change while this is iterated.
+        index_lo = None if lo is None else key_prefix_range((lo,))[0]
+        index_hi = None if hi is None else key_prefix_range((hi,))[1]
+        keys = []
+        for _, key in self.get_index(field).scan(index_lo, index_hi):
+            keys.append(key)
+            if len(keys) == SCAN_BATCH_CELLS:
+                yield from zip(keys, self.get_many(keys))
+                keys = []
+        yield from zip(keys, self.get_many(keys))
+
+    @pager_operation
+    def bulk_load(self, pairs, fill_factor: float = 1.0):
+        # Build the tree bottom-up from (key, val) pairs sorted by key.
+        # Leaves are packed left to right and linked through their sibling
+        # pointers, then each internal level is built from the max keys of
+        # the level below. No splits happen, so the split counts stay at zero.
+        if not 0 < fill_factor <= 1:
+            raise Exception(f"Fill factor must be in (0, 1], got {fill_factor}")
+
+        root = self._pager.get_page(self._root_page_num)
+        if not isinstance(root, BtreeNodeLeaf) or root.get_num_cells() > 0:
+            raise Exception("Cannot bulk load into a non-empty tree")
+
+        pairs = list(pairs)
+        for key, val in pairs:
+            self.check_cell(key, val)
+        index_keys = [self.index_keys(key, val) for key, val in pairs] if self._indexes else None
+        for i in range(1, len(pairs)):
+            if pairs[i - 1][0] >= pairs[i][0]:
+                raise Exception(f"Bulk load keys must be strictly increasing: {pairs[i][0]}")
+        if len(pairs) == 0:
+            return
+        self._rightmost_page_num = None
+        keys = [k for k, _ in pairs]
+        vals = [v for _, v in pairs]
+
+        # level entries are (page_num, max_key)
+        leaf_cells = max(1, int(self._leaf_max_cells * fill_factor))
+        groups = self.bulk_load_groups(len(pairs), leaf_cells)
+        level = []
+        prev_node = None
+        for start, end in groups:
+            is_root = len(groups) == 1
+            page_num = self._root_page_num if is_root else self._pager.get_unused_page_num()
+            node = self._pager.new_leaf(is_root=is_root)
+            node.extend_cells(keys[start:end], vals[start:end])
+            self._pager.set_page(page_num, node)
+            if prev_node is not None:
+                prev_node.set_next_leaf_ptr(page_num)
+            prev_node = node
+            level.append((page_num, keys[end - 1]))
+        self.build_internal_levels(level, fill_factor)
+
+        if self._wal is not None:
+            for key, val in pairs:
+                self._wal.log_insert(key, val)
+        if self._indexes:
+            for key, keys_of_row in zip(keys, index_keys):
+                self.index_insert(key, keys_of_row)
+
+    def build_internal_levels(self, level, fill_factor: float):
+        # Build the internal levels over level, the (page_num, max_key) of
+        # the nodes of one level from left to right, each internal node
+        # holding up to fill_factor of its capacity. The top one becomes
+        # the root, on the root page.
+        # at least 3 children per internal node so that no node is left
+        # with a right child only
+        internal_children = max(3, int((self._internal_max_cells + 1) * fill_factor))
+        while len(level) > 1:
+            groups = self.bulk_load_groups(len(level), internal_children)
+            next_level = []
+            for start, end in groups:
+                is_root = len(groups) == 1
+                page_num = self._root_page_num if is_root else self._pager.get_unused_page_num()
+                node = BtreeNodeInternal(is_root=is_root)
+                node.set_cells([child_page_num for child_page_num, _ in level[start:end - 1]],
+                               [child_max_key for _, child_max_key in level[start:end - 1]],
+                               level[end - 1][0])
+                node.set_max_key(level[end - 1][1])
+                self._pager.set_page(page_num, node)
+                next_level.append((page_num, level[end - 1][1]))
+            level = next_level
+
+    @staticmethod
+    def bulk_load_groups(num_items: int, max_per_group: int):
+        # Divide num_items into the fewest groups of at most max_per_group,
+        # spreading the remainder so that group sizes differ by at most one.
+        num_groups = -(-num_items // max_per_group)
+        base, extra = divmod(num_items, num_groups)
+        groups = []
+        start = 0
+        for i in range(num_groups):
+            end = start + base + (1 if i < extra else 0)
+            groups.append((start, end))
+            start = end
+        return groups
+
+    @pager_operation
+    def compact(self, fill_factor: float = 1.0, max_leaves: int = None):
+        # Repack the leaves to fill_factor of their capacity and release
+        # the pages left over to the pager. Without max_leaves, the whole
+        # leaf chain is repacked in one go and the internal levels are
+        # rebuilt over it as in bulk_load. With max_leaves, at most that
+        # many leaves of one parent are repacked per call, starting where
+        # the last call stopped, so that compaction can be interleaved with
+        # other operations. Returns the page counts before and after and
+        # whether a pass over the tree is done.
+        if not 0 < fill_factor <= 1:
+            raise Exception(f"Fill factor must be in (0, 1], got {fill_factor}")
+        if max_leaves is not None and max_leaves < 2:
+            raise Exception(f"max_leaves must be at least 2, got {max_leaves}")
+
+        num_pages = self._pager.get_num_pages()
+        leaf_cells = max(1, int(self._leaf_max_cells * fill_factor))
+        if max_leaves is None:
+            self.compact_tree(leaf_cells, fill_factor)
+            done = True
+        else:
+            done = self.compact_leaves(leaf_cells, max_leaves)
+        return {"pages_before": num_pages, "pages_after": self._pager.get_num_pages(), "done": done}
+
+    def compact_tree(self, leaf_cells: int, fill_factor: float):
+        root = self._pager.get_page(self._root_page_num)
+        if isinstance(root, BtreeNodeLeaf):
+            return
+        self._rightmost_page_num = None
+        self._compact_key = None
+
+        # the internal pages below the root, level by level
+        internal_page_nums = []
+        level = [self._root_page_num]
+        while isinstance(self._pager.get_page(level[0]), BtreeNodeInternal):
+            if level[0] != self._root_page_num:
+                internal_page_nums.extend(level)
+            next_level = []
+            for page_num in level:
+                node: BtreeNodeInternal = self._pager.get_page(page_num)
+                next_level.extend(node.get_child_ptr(i) for i in range(node.get_num_keys() + 1))
+            level = next_level
+
+        # the cells of the leaf chain, taken out of the leaves
+        leaf_page_nums = []
+        keys = []
+        vals = []
+        page_num = level[0]
+        while page_num != 0:
+            node: BtreeNodeLeaf = self._pager.get_page(page_num)
+            leaf_page_nums.append(page_num)
+            leaf_keys, leaf_vals = node.truncate_cells(0)
+            keys.extend(leaf_keys)
+            vals.extend(leaf_vals)
+            page_num = node.get_next_leaf_ptr()
+
+        for page_num in internal_page_nums:
+            self._pager.free_page(page_num)
+        groups = self.bulk_load_groups(len(keys), leaf_cells) if keys else []
+        for page_num in leaf_page_nums[max(len(groups), 1):]:
+            self._pager.free_page(page_num)
+        while len(leaf_page_nums) < len(groups):
+            # a fill factor below the current one needs more leaves
+            leaf_page_nums.append(self._pager.get_unused_page_num())
+        if len(groups) <= 1:
+            # a single leaf is the new root
+            node = self._pager.get_page(leaf_page_nums[0])
+            node.extend_cells(keys, vals)
+            node.set_next_leaf_ptr(0)
+            node.set_is_root(True)
+            self._pager.set_page(self._root_page_num, node)
+            self._pager.free_page(leaf_page_nums[0])
+            return
+
+        # the first leaves of the chain take the cells, in order
+        level = []
+        for i, (start, end) in enumerate(groups):
+            node = self._pager.get_page(leaf_page_nums[i])
+            node.extend_cells(keys[start:end], vals[start:end])
+            node.set_next_leaf_ptr(leaf_page_nums[i + 1] if i + 1 < len(groups) else 0)
+            level.append((leaf_page_nums[i], keys[end - 1]))
+        self.build_internal_levels(level, fill_factor)
+
+    def compact_leaves(self, leaf_cells: int, max_leaves: int) -> bool:
+        # Repack up to max_leaves consecutive children of one parent, from
+        # the leaf of _compact_key on, into as few leaves as will hold them.
+        # The leaves left empty are released and removed from the parent,
+        # which is then rebalanced like after a delete. Returns True when
+        # the last leaf has been reached.
+        root = self._pager.get_page(self._root_page_num)
+        if isinstance(root, BtreeNodeLeaf):
+            self._compact_key = None
+            return True
+
+        if self._compact_key is None:
+            path = []
+            page_num = self._root_page_num
+            while isinstance(root, BtreeNodeInternal):
+                path.append((page_num, 0))
+                page_num = root.get_child_ptr(0)
+                root = self._pager.get_page(page_num)
+        else:
+            _, _, path, _ = self.find_leaf(self._compact_key)
+        parent_page_num, child_index = path[-1]
+        parent: BtreeNodeInternal = self._pager.get_page(parent_page_num)
+        last_index = min(parent.get_num_keys(), child_index + max_leaves - 1)
+        nodes = [self._pager.get_page(parent.get_child_ptr(i)) for i in range(child_index, last_index + 1)]
+        next_page_num = nodes[-1].get_next_leaf_ptr()
+
+        num_cells = sum(node.get_num_cells() for node in nodes)
+        groups = self.bulk_load_groups(num_cells, leaf_cells) if num_cells > 0 else [(0, 0)]
+        if len(groups) < len(nodes):
+            self._rightmost_page_num = None
+            keys = []
+            vals = []
+            for node in nodes:
+                node_keys, node_vals = node.truncate_cells(0)
+                keys.extend(node_keys)
+                vals.extend(node_vals)
+            for i, (start, end) in enumerate(groups):
+                nodes[i].extend_cells(keys[start:end], vals[start:end])
+                if i + 1 < len(groups):
+                    parent.set_key(child_index + i, keys[end - 1])
+            # the last leaf kept takes over the place of the ones released
+            kept_index = child_index + len(groups) - 1
+            nodes[len(groups) - 1].set_next_leaf_ptr(next_page_num)
+            for _ in range(len(groups), len(nodes)):
+                self._pager.free_page(parent.get_child_ptr(kept_index + 1))
+                parent.remove_child(kept_index)
+            self.internal_node_rebalance(path, len(path) - 1)
+
+        if next_page_num == 0:
+            self._compact_key = None
+            return True
+        self._compact_key = self._pager.get_page(next_page_num).get_key(0)
+        return False
+
+    def update_max_key(self, path, max_key: int):
+        # Raise the max key of the nodes on path before max_key is appended
+        # to the end of the leaf below it. Only ancestors reached through
+        # right child pointers can have their max key changed.
+        for page_num, child_index in reversed(path):
+            node = self._pager.load_page(page_num)
+            if child_index != node.get_num_keys():
+                break
+            self._pager.get_page(page_num).set_max_key(max_key)
 
     def table_find(self, key: int) -> Cursor:
-        root_node = self._pager.get_page(self._root_page_num)
+        # Nodes are looked at through load_page, here and in find_leaf:
+        # callers that go on to change a node take it with get_page, so
+        # that snapshots keep the version they see.
+        root_node = self._pager.load_page(self._root_page_num)
         if isinstance(root_node, BtreeNodeLeaf):
             return self.leaf_node_find(self._root_page_num, key)
         elif isinstance(root_node, BtreeNodeInternal):
@@ -371,207 +2567,168 @@ class Btree:
         else:
             raise Exception(f"Unknown instance type for {root_node}")
 
+    def find_leaf(self, key, path=(), bounds=()):
+        # Iterative descent to the leaf for key, returning
+        # (page_num, node, path, bounds) where bounds[i] is the upper bound
+        # of the keys below path[i] (None if unbounded). Given the path and
+        # bounds of a smaller key, the descent starts from the lowest node on
+        # that path whose subtree can still contain key, not from the root.
+        depth = len(path) - 1
+        while depth >= 0 and bounds[depth] is not None and key > bounds[depth]:
+            depth -= 1
+
+        if depth < 0:
+            path = []
+            bounds = []
+            page_num = self._root_page_num
+            bound = None
+        else:
+            path = path[:depth + 1]
+            bounds = bounds[:depth + 1]
+            parent_page_num, child_index = path[depth]
+            page_num = self._pager.load_page(parent_page_num).get_child_ptr(child_index)
+            bound = bounds[depth]
+
+        load_page = self._pager.load_page
+        node = load_page(page_num)
+        while isinstance(node, BtreeNodeInternal):
+            child_index = node.find_child(key)
+            if child_index < node.get_num_keys():
+                bound = node.get_key(child_index)
+            path.append((page_num, child_index))
+            bounds.append(bound)
+            page_num = node.get_child_ptr(child_index)
+            node = load_page(page_num)
+        return page_num, node, path, bounds
+
+    @staticmethod
+    def leaf_group_end(keys, start: int, bounds) -> int:
+        # End of the run of sorted keys from start that belong in the leaf
+        # whose path has the given bounds.
+        if len(bounds) == 0 or bounds[-1] is None:
+            return len(keys)
+        return bisect_right(keys, bounds[-1], start)
+
+    def find_leaf_groups(self, keys):
+        # For sorted keys, yield (page_num, node, path, start, end) for each
+        # run keys[start:end] that falls into one leaf. The tree must not
+        # change while this is iterated.
+        path = bounds = ()
+        start = 0
+        while start < len(keys):
+            page_num, node, path, bounds = self.find_leaf(keys[start], path, bounds)
+            end = self.leaf_group_end(keys, start, bounds)
+            yield page_num, node, path, start, end
+            start = end
+
     def leaf_node_find(self, page_num: int, key: int):
-        node = self._pager.get_page(page_num)
-        num_cells = node.get_num_cells()
+        node = self._pager.load_page(page_num)
 
         # get cursor
         cursor = self.get_cursor(page_num)
-
-        # binary search
-        min_index = 0
-        one_past_max_index = num_cells
-        while one_past_max_index != min_index:
-            index = (min_index + one_past_max_index) // 2
-            key_at_index = node.get_key(cell_num=index)
-            if key == key_at_index:
-                cursor.set_cell_num(index)
-                return cursor
-            if key < key_at_index:
-                one_past_max_index = index
-            else:
-                min_index = index + 1
-
-        cursor.set_cell_num(min_index)
+        cursor.set_cell_num(node.find_cell(key))
         return cursor
 
-    def internal_node_find(self, page_num: int, key: int) -> Cursor:
+    def internal_node_find(self, page_num: int, key: int, path=None) -> Cursor:
+        # path collects (page_num, child_index) for every internal node
+        # visited, so that splits can be propagated back up without
+        # parent pointers on the children.
+        if path is None:
+            path = []
 
-        node: BtreeNodeInternal = self._pager.get_page(page_num=page_num)
+        node: BtreeNodeInternal = self._pager.load_page(page_num)
         child_index = node.find_child(key)
+        path.append((page_num, child_index))
         child_page_num = node.get_child_ptr(child_index)
-        child = self._pager.get_page(page_num=child_page_num)
+        child = self._pager.load_page(child_page_num)
 
         if isinstance(child, BtreeNodeLeaf):
-            return self.leaf_node_find(child_page_num, key)
+            cursor = self.leaf_node_find(child_page_num, key)
+            cursor.set_path(path)
+            return cursor
         elif isinstance(child, BtreeNodeInternal):
-            return self.internal_node_find(child_page_num, key)
+            return self.internal_node_find(child_page_num, key, path)
         else:
             raise Exception(f"Unknown instance type for {child}")
 
     def create_new_root(self, right_child_page_num: int):
         #  Handle splitting the root.
-        #  Old root copied to new page, becomes left child.
+        #  Old root node moved to a new page, becomes left child.
         #  Address of right child passed in.
         #  Re-initialize root page to contain the new root node.
         #  New root node points to two children.
         self._split_cnt_root += 1
+        self._rightmost_page_num = None
 
         # get current root
         root = self._pager.get_page(self._root_page_num)
         right_child = self._pager.get_page(right_child_page_num)
 
-        if isinstance(root, BtreeNodeInternal):
-            right_child = BtreeNodeInternal(is_root=False)
-            self._pager.set_page(right_child_page_num, right_child)
-
-        # Left child has data copied from old root
-        left_child = root.copy()
+        # The old root node moves to a new page as the left child, as is
+        left_child = root
         left_child.set_is_root(False)
         left_child_page_num = self._pager.get_unused_page_num()
         self._pager.set_page(left_child_page_num, left_child)
 
-        if isinstance(left_child, BtreeNodeInternal):
-            for i in range(0, left_child.get_num_keys()):
-                ptr, _ = left_child.get_cell(i)
-                child = self._pager.get_page(ptr)
-                child.set_parent_ptr(left_child_page_num)
-            child = self._pager.get_page(left_child.get_right_child_ptr())
-            child.set_parent_ptr(left_child_page_num)
-
         # Root node is a new internal node with one key and two children
         root = BtreeNodeInternal(is_root=True)
-        root.set_num_keys(1)
         left_child_max_key = self._pager.get_node_max_key(left_child)
-        root.set_cell(cell_num=0, cell=(left_child_page_num, left_child_max_key))
-        root.set_right_child_ptr(right_child_page_num)
+        root.set_cells([left_child_page_num], [left_child_max_key], right_child_page_num)
+        root.set_max_key(right_child.get_max_key())
         self._pager.set_page(self._root_page_num, root)
-        left_child.set_parent_ptr(self._root_page_num)
-        right_child.set_parent_ptr(self._root_page_num)
-
-    def internal_node_insert(self, parent_page_num: int, child_page_num: int):
-
-        #  Add a new child/key pair to parent that corresponds to child
-        parent = self._pager.get_page(parent_page_num)
-        child = self._pager.get_page(child_page_num)
-        child_max_key = self._pager.get_node_max_key(child)
-
-        index = parent.find_child(child_max_key)
 
-        original_num_keys = parent.get_num_keys()
+    def internal_node_insert(self, path, depth: int, left_max_key: int, new_child_page_num: int):
+        #  The child at path[depth] was split. It keeps its position with
+        #  left_max_key as its new key, and new_child_page_num is added
+        #  directly to its right.
+        self._rightmost_page_num = None
+        parent_page_num, child_index = path[depth]
+        parent: BtreeNodeInternal = self._pager.get_page(parent_page_num)
 
-        if original_num_keys >= INTERNAL_NODE_MAX_CELLS:
-            self.internal_node_split_and_insert(parent_page_num, child_page_num)
+        if parent.get_num_keys() >= self._internal_max_cells:
+            self.internal_node_split_and_insert(path, depth, left_max_key, new_child_page_num)
             return
 
-        right_child_page_num = parent.get_right_child_ptr()
+        parent.insert_child(child_index, left_max_key, new_child_page_num)
 
-        # An internal node with a right child of INVALID_PAGE_NUM is empty
-        if right_child_page_num == INVALID_PAGE_NUM:
-            parent.set_right_child_ptr(child_page_num)
-            return 
-
-        right_child = self._pager.get_page(right_child_page_num)
-        right_child_max_key = self._pager.get_node_max_key(right_child)
-
-        # If we are already at the max number of cells for a node, we cannot increment
-        # before splitting. Incrementing without inserting a new key/child pair
-        # and immediately calling internal_node_split_and_insert has the effect
-        # of creating a new key at (max_cells + 1) with an uninitialized value
-        parent.set_num_keys(original_num_keys + 1)
-
-        if (child_max_key > right_child_max_key):
-            # replace right child
-            parent.set_cell(original_num_keys, (right_child_page_num, right_child_max_key))
-            parent.set_right_child_ptr(child_page_num)
-        else:
-            # Make room for the new cell
-            for i in range(original_num_keys, index, -1):
-                parent.set_cell(i, parent.get_cell(i - 1))
-            parent.set_cell(index, (child_page_num, child_max_key))
-
-    def internal_node_split_and_insert(self, parent_page_num: int, child_page_num: int) -> None:
+    def internal_node_split_and_insert(self, path, depth: int, left_max_key: int,
+                                       new_child_page_num: int) -> None:
         self._split_cnt_internal_node += 1
 
-        old_page_num = parent_page_num
-        old_node = self._pager.get_page(parent_page_num)
-        old_max = self._pager.get_node_max_key(old_node)
+        old_page_num, child_index = path[depth]
+        old_node: BtreeNodeInternal = self._pager.get_page(old_page_num)
 
-        child = self._pager.get_page(child_page_num)
-        child_max = self._pager.get_node_max_key(child)
+        # The node is on the right edge of the tree if it holds the max key
+        root = self._pager.load_page(self._root_page_num)
+        is_rightmost = old_node.get_max_key() == root.get_max_key()
+
+        # Insert first, then move the cells above the split key and the
+        # right child to a new node in one slice. The child before the
+        # split key becomes the old node's right child.
+        old_node.insert_child(child_index, left_max_key, new_child_page_num)
+        num_children = old_node.get_num_keys() + 1
+        left_children = self._split_policy.split_point(num_children, child_index + 1, is_rightmost, False)
+        # at least 2 children on each side, as in build_internal_levels, so
+        # that neither node is left with a right child only
+        left_children = min(max(left_children, 2), num_children - 2)
+        split_index = left_children - 1
 
         new_page_num = self._pager.get_unused_page_num()
-            
-        # Declaring a flag before updating pointers which
-        # records whether this operation involves splitting the root -
-        # if it does, we will insert our newly created node during
-        # the step where the table's new root is created. If it does
-        # not, we have to insert the newly created node into its parent
-        # after the old node's keys have been transferred over. We are not
-        # able to do this if the newly created node's parent is not a newly
-        # initialized root node, because in that case its parent may have existing
-        # keys aside from our old node which we are splitting. If that is true, we
-        # need to find a place for our newly created node in its parent, and we
-        # cannot insert it at the correct index if it does not yet have any keys
-        splitting_root = old_node.is_root()
-
-        if splitting_root:
-            self.create_new_root(new_page_num)
-            parent = self._pager.get_page(self._root_page_num)
-
-            # If we are splitting the root, we need to update old_node to point
-            # to the new root's left child, new_page_num will already point to
-            # the new root's right child
-
-            old_page_num, _ = parent.get_cell(0)
-            old_node = self._pager.get_page(old_page_num)
+        new_node = BtreeNodeInternal(is_root=False)
+        new_node.set_cells(*old_node.truncate_cells(split_index))
+        new_node.set_max_key(old_node.get_max_key())
+        self._pager.set_page(new_page_num, new_node)
+
+        right_child = self._pager.load_page(old_node.get_right_child_ptr())
+        old_node.set_max_key(self._pager.get_node_max_key(right_child))
+
+        if old_node.is_root():
+            self.create_new_root(right_child_page_num=new_page_num)
         else:
-            parent = self._pager.get_page(old_node.get_parent_ptr())
-            new_node = BtreeNodeInternal(is_root=False)
-            self._pager.set_page(new_page_num, new_node)
-
-        old_num_keys = old_node.get_num_keys()
-        cur_page_num = old_node.get_right_child_ptr()
-        cur = self._pager.get_page(cur_page_num)
-
-        # First put right child into new node and set right child of old node to invalid page number
-        self.internal_node_insert(new_page_num, cur_page_num)
-        cur.set_parent_ptr(new_page_num)
-        old_node.set_right_child_ptr(INVALID_PAGE_NUM)
-
-        # For each key until you get to the middle key, move the key and the child to the new node
-        for i in range(INTERNAL_NODE_MAX_CELLS - 1, INTERNAL_NODE_MAX_CELLS // 2, -1):
-            cur_page_num, _ = old_node.get_cell(i)
-            cur = self._pager.get_page(cur_page_num)
-
-            self.internal_node_insert(new_page_num, cur_page_num)
-            cur.set_parent_ptr(new_page_num)
-
-            old_num_keys -= 1
-            old_node.set_num_keys(old_num_keys)
-
-        # Set child before middle key, which is now the highest key, to be node's right child,
-        # and decrement number of keys
-        ptr, _ = old_node.get_cell(old_num_keys - 1)
-        old_node.set_right_child_ptr(ptr)
-        old_num_keys -= 1
-        old_node.set_num_keys(old_num_keys)
-
-        # Determine which of the two nodes after the split should contain the child to be inserted,
-        # and insert the child
-        max_after_split = self._pager.get_node_max_key(old_node)
-        destination_page_num = old_page_num if child_max < max_after_split else new_page_num
-
-        self.internal_node_insert(destination_page_num, child_page_num)
-        child.set_parent_ptr(destination_page_num)
-        parent.update_key(old_max, self._pager.get_node_max_key(old_node))
-
-        if not splitting_root:
-            self.internal_node_insert(old_node.get_parent_ptr(), new_page_num)
-            new_node.set_parent_ptr(old_node.get_parent_ptr())
+            self.internal_node_insert(path, depth - 1, old_node.get_max_key(), new_page_num)
 
     def print(self, page_num: int = 0, indentation_level: int = 0):
-        node = self._pager.get_page(page_num)
+        node = self._pager.load_page(page_num)
 
         if isinstance(node, BtreeNodeLeaf):
             num_keys = node.get_num_cells()
@@ -593,3 +2750,586 @@ class Btree:
                 child_page_num = node.get_right_child_ptr()
                 self.print(child_page_num, indentation_level + 1)
 
+class BtreeSnapshot(Btree):
+    # Read-only Btree over a SnapshotPager. Use it as a context manager or
+    # call release() when done.
+    def __init__(self, pager: SnapshotPager, split_policy: SplitPolicy = None,
+                 leaf_capacity: int = None, internal_capacity: int = None):
+        super().__init__(split_policy=split_policy, pager=pager,
+                         leaf_capacity=leaf_capacity, internal_capacity=internal_capacity)
+
+    def release(self):
+        self._pager.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def execute_insert(self, key: int, val):
+        raise Exception("Snapshots are read-only")
+
+    def execute_insert_many(self, pairs):
+        raise Exception("Snapshots are read-only")
+
+    def execute_delete(self, key):
+        raise Exception("Snapshots are read-only")
+
+    def bulk_load(self, pairs, fill_factor: float = 1.0):
+        raise Exception("Snapshots are read-only")
+
+    def compact(self, fill_factor: float = 1.0, max_leaves: int = None):
+        raise Exception("Snapshots are read-only")
+
+    def checkpoint(self):
+        raise Exception("Snapshots are read-only")
+
+class Latch:
+    # Read/write latch on a page: any number of readers or one writer. A
+    # waiting writer keeps new readers out, so readers cannot starve it.
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._num_readers = 0
+        self._num_writers_waiting = 0
+        self._writer = False
+
+    def acquire_read(self, blocking: bool = True) -> bool:
+        with self._cond:
+            while self._writer or self._num_writers_waiting > 0:
+                if not blocking:
+                    return False
+                self._cond.wait()
+            self._num_readers += 1
+            return True
+
+    def release_read(self):
+        with self._cond:
+            self._num_readers -= 1
+            if self._num_readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._num_writers_waiting += 1
+            while self._writer or self._num_readers > 0:
+                self._cond.wait()
+            self._num_writers_waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+class ConcurrentBtree(Btree):
+    # Btree that can be used from several threads at once, with a read/write
+    # latch per page. Both readers and writers descend by latch crabbing: the
+    # child is latched before the parent is let go. Readers hold one latch
+    # at a time. Writers keep the latches of the ancestors that the change
+    # may reach (a full node on insert, one at its minimum or whose max key
+    # is deleted on delete, ...) and let go of all of them as soon as they
+    # get to a safe node. Latches are only ever waited for top-down, or for
+    # a sibling while holding the parent; scans move to the next leaf only if
+    # its latch is free right away, so there are no deadlocks.
+    # There is no rightmost-leaf fast path and no WAL, the split and merge
+    # counts are approximate with several writers, and snapshot, checkpoint
+    # and the Cursor methods must not run alongside writers. bulk_load and
+    # compact latch the tree for as long as they run.
+    def __init__(self, split_policy: SplitPolicy = None, pager: Pager = None,
+                 leaf_capacity: int = None, internal_capacity: int = None):
+        self._latches = {}
+        super().__init__(split_policy=split_policy, pager=pager,
+                         leaf_capacity=leaf_capacity, internal_capacity=internal_capacity)
+
+    def latch(self, page_num: int) -> Latch:
+        latch = self._latches.get(page_num)
+        if latch is None:
+            latch = self._latches.setdefault(page_num, Latch())
+        return latch
+
+    def release_write(self, latched):
+        for page_num in latched:
+            self.latch(page_num).release_write()
+
+    def read_leaf(self, key):
+        # Crab down to the leaf for key (the leftmost leaf if key is None)
+        # with read latches. Return (page_num, node, bound) with the leaf's
+        # latch held, bound being the upper bound of its keys (None if
+        # unbounded).
+        load_page = self._pager.load_page
+        page_num = self._root_page_num
+        latch = self.latch(page_num)
+        latch.acquire_read()
+        node = load_page(page_num)
+        bound = None
+        while isinstance(node, BtreeNodeInternal):
+            child_index = 0 if key is None else node.find_child(key)
+            if child_index < node.get_num_keys():
+                bound = node.get_key(child_index)
+            page_num = node.get_child_ptr(child_index)
+            child_latch = self.latch(page_num)
+            child_latch.acquire_read()
+            latch.release_read()
+            latch = child_latch
+            node = load_page(page_num)
+        return page_num, node, bound
+
+    def write_path(self, key, is_safe):
+        # Crab down to the leaf for key with write latches, letting go of
+        # the latched ancestors whenever is_safe(node, key) says a change
+        # below node cannot reach them. Return (latched, path, page_num,
+        # node) with latched the page nums still held, from the top down.
+        get_page = self._pager.get_page
+        page_num = self._root_page_num
+        self.latch(page_num).acquire_write()
+        latched = [page_num]
+        path = []
+        node = get_page(page_num)
+        while isinstance(node, BtreeNodeInternal):
+            child_index = node.find_child(key)
+            path.append((page_num, child_index))
+            page_num = node.get_child_ptr(child_index)
+            self.latch(page_num).acquire_write()
+            node = get_page(page_num)
+            if is_safe(node, key):
+                self.release_write(latched)
+                latched = []
+            latched.append(page_num)
+        return latched, path, page_num, node
+
+    def insert_is_safe(self, node, key) -> bool:
+        # the node will not split and its max key stays the same
+        if isinstance(node, BtreeNodeLeaf):
+            num_cells = node.get_num_cells()
+            return 0 < num_cells < self._leaf_max_cells and key <= node.get_max_key()
+        return node.get_num_keys() < self._internal_max_cells and key <= node.get_max_key()
+
+    def delete_is_safe(self, node, key) -> bool:
+        # the node will not be rebalanced and its max key stays the same
+        if isinstance(node, BtreeNodeLeaf):
+            return node.get_num_cells() > self._leaf_min_cells and key < node.get_max_key()
+        return node.get_num_keys() > self._internal_min_cells and key < node.get_max_key()
+
+    def get(self, key, default=None):
+        page_num, node, _ = self.read_leaf(key)
+        try:
+            cell_num = node.find_cell(key)
+            if cell_num < node.get_num_cells() and node.get_key(cell_num) == key:
+                return node.get_value(cell_num)
+            return default
+        finally:
+            self.latch(page_num).release_read()
+
+    def get_many(self, keys, default=None):
+        # As Btree.get_many, with one descent per leaf holding any of the keys.
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        sorted_keys = [keys[i] for i in order]
+
+        out = [default] * len(keys)
+        start = 0
+        while start < len(sorted_keys):
+            page_num, node, bound = self.read_leaf(sorted_keys[start])
+            try:
+                end = self.leaf_group_end(sorted_keys, start, (bound,))
+                vals = node.find_values(sorted_keys[start:end], default)
+            finally:
+                self.latch(page_num).release_read()
+            for i, val in zip(order[start:end], vals):
+                out[i] = val
+            start = end
+        return out
+
+    def scan(self, lo=None, hi=None):
+        # As Btree.scan, but the tree may change while this is iterated. Up
+        # to SCAN_BATCH_CELLS pairs are copied out under the leaf latches
+        # before they are yielded, so no latch is held across a yield. The
+        # next batch starts from a new descent to the last key handed out.
+        # Each pair is yielded once, and pairs inserted or deleted meanwhile
+        # may or may not be seen.
+        key = lo
+        after_key = False
+        while True:
+            page_num, node, _ = self.read_leaf(key)
+            latch = self.latch(page_num)
+            if key is None:
+                cell_num = 0
+            elif after_key:
+                cell_num = node.find_cell_after(key, 0)
+            else:
+                cell_num = node.find_cell(key)
+            batch = []
+            done = False
+            try:
+                while True:
+                    num_cells = node.get_num_cells()
+                    end = num_cells if hi is None else node.find_cell_after(hi, cell_num)
+                    batch.extend(node.get_cells(cell_num, end))
+                    page_num = node.get_next_leaf_ptr()
+                    if end < num_cells or page_num == 0:
+                        done = True
+                        break
+                    if len(batch) >= SCAN_BATCH_CELLS:
+                        break
+                    # a writer may be waiting for this leaf while holding the
+                    # next one, so only move on if the next one is free
+                    next_latch = self.latch(page_num)
+                    if not next_latch.acquire_read(blocking=False):
+                        break
+                    latch.release_read()
+                    latch = next_latch
+                    node = self._pager.load_page(page_num)
+                    cell_num = 0
+            finally:
+                latch.release_read()
+            yield from batch
+            if done:
+                return
+            if batch:
+                key = batch[-1][0]
+                after_key = True
+
+    @pager_operation
+    def execute_insert(self, key: int, val):
+        self.check_cell(key, val)
+        latched, path, page_num, node = self.write_path(key, self.insert_is_safe)
+        try:
+            cell_num = node.find_cell(key)
+            if cell_num < node.get_num_cells() and node.get_key(cell_num) == key:
+                raise Exception(f"Cannot insert a duplicate key: {key}")
+            self._insert_cnt += 1
+            cursor = self.get_cursor(page_num)
+            cursor.set_cell_num(cell_num)
+            cursor.set_path(path)
+            cursor.leaf_node_insert(key, val)
+        finally:
+            self.release_write(latched)
+
+    @pager_operation
+    def execute_insert_many(self, pairs):
+        # one insert at a time, so readers are not held up for the batch
+        for key, val in sorted(pairs, key=itemgetter(0)):
+            self.execute_insert(key, val)
+
+    @pager_operation
+    def execute_delete(self, key):
+        latched, path, page_num, node = self.write_path(key, self.delete_is_safe)
+        try:
+            cell_num = node.find_cell(key)
+            if cell_num == node.get_num_cells() or node.get_key(cell_num) != key:
+                raise Exception(f"Cannot delete a missing key: {key}")
+            if node.get_num_cells() <= self._leaf_min_cells:
+                latched += self.latch_siblings(path, len(path) - len(latched) + 1)
+            self.leaf_node_delete(path, node, cell_num)
+        finally:
+            self.release_write(latched)
+
+    def latch_siblings(self, path, depth: int):
+        # Write-latch the sibling that each node below path[depth] would be
+        # merged with or rebalanced against, and return their page nums.
+        siblings = []
+        for parent_page_num, child_index in path[max(depth, 0):]:
+            parent: BtreeNodeInternal = self._pager.get_page(parent_page_num)
+            if parent.get_num_keys() == 0:
+                continue
+            sibling_index = child_index - 1 if child_index > 0 else 1
+            sibling_page_num = parent.get_child_ptr(sibling_index)
+            self.latch(sibling_page_num).acquire_write()
+            siblings.append(sibling_page_num)
+        return siblings
+
+    @pager_operation
+    def bulk_load(self, pairs, fill_factor: float = 1.0):
+        # readers wait at the root until the whole tree is built
+        latch = self.latch(self._root_page_num)
+        latch.acquire_write()
+        try:
+            super().bulk_load(pairs, fill_factor)
+        finally:
+            latch.release_write()
+
+    @pager_operation
+    def compact(self, fill_factor: float = 1.0, max_leaves: int = None):
+        # Compaction moves cells between leaves and rebuilds internal nodes
+        # anywhere in the tree, so it runs with the whole tree latched
+        latched = self.latch_tree()
+        try:
+            return super().compact(fill_factor, max_leaves)
+        finally:
+            self.release_write(latched)
+
+    def latch_tree(self):
+        # Write-latch every page, top down and level by level, each node
+        # before its children are read. Returns the page nums latched, once
+        # every reader and writer in the tree has let go.
+        latched = []
+        level = [self._root_page_num]
+        while level:
+            next_level = []
+            for page_num in level:
+                self.latch(page_num).acquire_write()
+                latched.append(page_num)
+                node = self._pager.load_page(page_num)
+                if isinstance(node, BtreeNodeInternal):
+                    next_level.extend(node.get_child_ptr(i) for i in range(node.get_num_keys()))
+                    next_level.append(node.get_right_child_ptr())
+            level = next_level
+        return latched
+
+    def get_field(self, key, field, default=None):
+        val = self.get(key)
+        return default if val is None else val[field]
+
+    def scan_field(self, field, lo=None, hi=None):
+        for key, val in self.scan(lo, hi):
+            yield key, val[field]
+
+    def create_index(self, field):
+        # index updates would not be atomic with the row changes
+        raise Exception("Secondary indexes are not supported on a ConcurrentBtree")
+
+def shard_worker(conn, leaf_capacity: int = None, internal_capacity: int = None):
+    # Serve one shard of a ShardedBtree: a Btree of its own, driven by
+    # (op, *args) requests on conn. Every request is answered with
+    # ("ok", result, num_keys) or ("error", message, num_keys).
+    btree = Btree(leaf_capacity=leaf_capacity, internal_capacity=internal_capacity)
+    num_keys = 0
+    while True:
+        op, *args = conn.recv()
+        if op == "close":
+            conn.close()
+            return
+        try:
+            if op == "insert_many":
+                btree.execute_insert_many(args[0])
+                num_keys += len(args[0])
+                result = None
+            elif op == "get_many":
+                result = btree.get_many(*args)
+            elif op == "delete":
+                btree.execute_delete(args[0])
+                num_keys -= 1
+                result = None
+            elif op == "scan":
+                # up to limit pairs from lo, or from after lo
+                lo, hi, limit, after_lo = args
+                pairs = btree.scan(lo, hi)
+                if after_lo:
+                    pairs = (pair for pair in pairs if pair[0] != lo)
+                result = []
+                for pair in pairs:
+                    result.append(pair)
+                    if len(result) == limit:
+                        break
+            elif op == "pop":
+                # Remove the lowest or highest count pairs. Return them and
+                # the key a boundary between them and the rest can be set to.
+                count, from_top = args
+                pairs = list(btree.scan())
+                cut = len(pairs) - count if from_top else count
+                moved = pairs[cut:] if from_top else pairs[:cut]
+                for key, _ in moved:
+                    btree.execute_delete(key)
+                num_keys -= len(moved)
+                result = (moved, pairs[cut][0])
+            else:
+                raise Exception(f"Unknown shard op {op}")
+        except Exception as e:
+            # a failed batch may have been applied in part
+            num_keys = sum(1 for _ in btree.scan())
+            conn.send(("error", str(e), num_keys))
+        else:
+            conn.send(("ok", result, num_keys))
+
+class ShardedBtree:
+    # Key-range partitioned tree. Shard i owns the keys below boundaries[i]
+    # and from boundaries[i - 1] up (the last shard owns the rest) and is a Btree in a
+    # worker process of its own, so shards insert and search in parallel.
+    # Inserts are buffered and sent per shard in batches of batch_size,
+    # lookups in get_many are split per shard and sent all at once, and
+    # scans are a k-way merge of the scans of the shards in range. When a
+    # shard grows to more than rebalance_ratio times the mean, keys move
+    # between neighbouring shards and the boundary between them with them.
+    # Use it as a context manager or call close() when done.
+    def __init__(self, num_shards: int = None, boundaries=None,
+                 batch_size: int = SHARD_BATCH_SIZE,
+                 rebalance_ratio: float = SHARD_REBALANCE_RATIO,
+                 leaf_capacity: int = None, internal_capacity: int = None):
+        if boundaries is None:
+            if num_shards is None:
+                num_shards = os.cpu_count() or 1
+            # spread evenly over the u32 keys of db.c
+            boundaries = [(i + 1) * (2 ** 32 // num_shards) for i in range(num_shards - 1)]
+        boundaries = list(boundaries)
+        for i in range(1, len(boundaries)):
+            if boundaries[i - 1] >= boundaries[i]:
+                raise Exception(f"Shard boundaries must be strictly increasing: {boundaries[i]}")
+        if num_shards is not None and len(boundaries) != num_shards - 1:
+            raise Exception(f"{num_shards} shards need {num_shards - 1} boundaries, got {len(boundaries)}")
+        if rebalance_ratio is not None and rebalance_ratio <= 1:
+            raise Exception(f"rebalance_ratio must be above 1, got {rebalance_ratio}")
+        self._boundaries = boundaries
+        self._batch_size = batch_size
+        self._rebalance_ratio = rebalance_ratio
+        self._conns = []
+        self._workers = []
+        for _ in range(len(boundaries) + 1):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=shard_worker, daemon=True,
+                                             args=(worker_conn, leaf_capacity, internal_capacity))
+            worker.start()
+            worker_conn.close()
+            self._conns.append(conn)
+            self._workers.append(worker)
+        self._num_keys = [0] * len(self._workers)
+        self._buffers = [[] for _ in self._workers]
+        self._num_buffered = 0
+        # counts
+        self._rebalance_cnt = 0
+        self._rebalance_cnt_keys = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for conn, worker in zip(self._conns, self._workers):
+            conn.send(("close",))
+            conn.close()
+            worker.join()
+        self._conns = []
+
+    def print_rebalance_counts(self):
+        print(f"Rebalance count: {self._rebalance_cnt}")
+        print(f"Rebalance count (keys moved): {self._rebalance_cnt_keys}")
+
+    def get_boundaries(self):
+        return list(self._boundaries)
+
+    def get_shard_sizes(self):
+        self.flush()
+        return list(self._num_keys)
+
+    def shard_of(self, key: int) -> int:
+        return bisect_right(self._boundaries, key)
+
+    def request(self, shard: int, *msg):
+        return self.request_all({shard: msg})[shard]
+
+    def request_all(self, msgs):
+        # Send {shard: msg} to all shards before waiting for any of them,
+        # so they work in parallel. Return {shard: result}; an error is
+        # raised once every shard has answered.
+        for shard, msg in msgs.items():
+            self._conns[shard].send(msg)
+        results = {}
+        error = None
+        for shard in msgs:
+            status, result, num_keys = self._conns[shard].recv()
+            self._num_keys[shard] = num_keys
+            if status == "error" and error is None:
+                error = result
+            results[shard] = result
+        if error is not None:
+            raise Exception(error)
+        return results
+
+    def execute_insert(self, key: int, val):
+        # buffered, see flush
+        self._buffers[self.shard_of(key)].append((key, val))
+        self._num_buffered += 1
+        if self._num_buffered >= self._batch_size:
+            self.flush()
+
+    def execute_insert_many(self, pairs):
+        for key, val in pairs:
+            self._buffers[self.shard_of(key)].append((key, val))
+            self._num_buffered += 1
+        self.flush()
+
+    def flush(self):
+        # Send the buffered inserts to their shards. Duplicates are only
+        # reported here, as for execute_insert_many on a Btree.
+        if self._num_buffered == 0:
+            return
+        msgs = {shard: ("insert_many", pairs) for shard, pairs in enumerate(self._buffers) if pairs}
+        self._buffers = [[] for _ in self._workers]
+        self._num_buffered = 0
+        self.request_all(msgs)
+        self.rebalance()
+
+    def execute_delete(self, key: int):
+        self.flush()
+        self.request(self.shard_of(key), "delete", key)
+
+    def get(self, key: int, default=None):
+        return self.get_many([key], default)[0]
+
+    def get_many(self, keys, default=None):
+        self.flush()
+        by_shard = {}
+        for i, key in enumerate(keys):
+            by_shard.setdefault(self.shard_of(key), []).append(i)
+        results = self.request_all({shard: ("get_many", [keys[i] for i in indexes], default)
+                                    for shard, indexes in by_shard.items()})
+        out = [default] * len(keys)
+        for shard, indexes in by_shard.items():
+            for i, val in zip(indexes, results[shard]):
+                out[i] = val
+        return out
+
+    def scan(self, lo=None, hi=None):
+        # Yield (key, val) pairs with lo <= key <= hi in key order, merging
+        # the scans of the shards whose ranges overlap [lo, hi]. Shards are
+        # read SCAN_BATCH_CELLS pairs at a time. The tree must not change
+        # while this is iterated.
+        self.flush()
+        first = 0 if lo is None else self.shard_of(lo)
+        last = len(self._workers) - 1 if hi is None else self.shard_of(hi)
+        yield from heapq.merge(*(self.shard_scan(shard, lo, hi) for shard in range(first, last + 1)),
+                               key=itemgetter(0))
+
+    def shard_scan(self, shard: int, lo, hi):
+        after_lo = False
+        while True:
+            pairs = self.request(shard, "scan", lo, hi, SCAN_BATCH_CELLS, after_lo)
+            yield from pairs
+            if len(pairs) < SCAN_BATCH_CELLS:
+                return
+            lo = pairs[-1][0]
+            after_lo = True
+
+    def execute_select(self):
+        for _, val in self.scan():
+            print(val)
+
+    def rebalance(self):
+        # While the largest shard is over rebalance_ratio times the mean,
+        # even out the neighbouring pair of shards with the largest
+        # difference in size by moving keys across the boundary between them.
+        if self._rebalance_ratio is None or len(self._workers) == 1:
+            return
+        while True:
+            mean = sum(self._num_keys) / len(self._num_keys)
+            largest = max(self._num_keys)
+            if largest < SHARD_REBALANCE_MIN_KEYS or largest <= self._rebalance_ratio * mean:
+                return
+            left = max(range(len(self._boundaries)),
+                       key=lambda i: abs(self._num_keys[i] - self._num_keys[i + 1]))
+            count = abs(self._num_keys[left] - self._num_keys[left + 1]) // 2
+            if count == 0:
+                return
+            self.move_keys(left, count)
+
+    def move_keys(self, left: int, count: int):
+        # Move count keys from the larger of shards left and left + 1 to
+        # the other one, across the boundary between them.
+        from_top = self._num_keys[left] > self._num_keys[left + 1]
+        source, target = (left, left + 1) if from_top else (left + 1, left)
+        pairs, boundary = self.request(source, "pop", count, from_top)
+        self._boundaries[left] = boundary
+        self.request(target, "insert_many", pairs)
+        self._rebalance_cnt += 1
+        self._rebalance_cnt_keys += len(pairs)
@@ -0,0 +1,328 @@
+import os
+import random
+import struct
+
+from btree import (FILE_TRAILER, FILE_TRAILER_OFFSET, NODE_INTERNAL, PAGE_SIZE, ROW_LAYOUT,
+                   WAL_CHECKPOINT_END, WAL_PAGE, AdaptiveSplitPolicy, AppendSplitPolicy, Btree,
+                   BtreeNodeInternal, BtreeNodeLeaf, EvenSplitPolicy, FilePager, Pager,
+                   WriteAheadLog, decode_key, encode_key)
+
+# Regression tests for btree.py, in the style of src/c/test.py. Run from
+# this directory with `python test.py`.
+
+def make_row(i):
+    return {"id": i, "user": f"person{i}", "email": f"person{i}@example.com"}
+
+def check_tree(btree: Btree):
+    # Walk the whole tree and return whether it is well formed: separators
+    # are the exact max keys of their subtrees, all leaves are at one depth,
+    # and no node other than the root is empty (no keys in an internal
+    # node, no cells in a leaf).
+    leaf_depths = set()
+    # (page_num, depth, lower bound exclusive, upper bound inclusive)
+    stack = [(btree._root_page_num, 0, None, None)]
+    while stack:
+        page_num, depth, lo, hi = stack.pop()
+        node = btree._pager.get_page(page_num)
+        if isinstance(node, BtreeNodeLeaf):
+            keys = [node.get_key(i) for i in range(node.get_num_cells())]
+            if not node.is_root() and len(keys) == 0:
+                return False
+            if keys != sorted(keys) or any((lo is not None and key <= lo) or
+                                           (hi is not None and key > hi) for key in keys):
+                return False
+            if keys and hi is not None and keys[-1] != hi:
+                return False
+            leaf_depths.add(depth)
+            continue
+        num_keys = node.get_num_keys()
+        if not node.is_root() and num_keys == 0:
+            return False
+        if hi is not None and node.get_max_key() != hi:
+            return False
+        prev = lo
+        for i in range(num_keys):
+            stack.append((node.get_child_ptr(i), depth + 1, prev, node.get_key(i)))
+            prev = node.get_key(i)
+        stack.append((node.get_right_child_ptr(), depth + 1, prev, node.get_max_key()))
+    return len(leaf_depths) <= 1
+
+# ----------------------------------------------------- #
+
+it = "keeps internal nodes non-empty with AppendSplitPolicy(left_fill=1.0)"
+status = "FAILED ❌"
+btree = Btree(split_policy=AppendSplitPolicy(left_fill=1.0))
+for i in range(6515):
+    btree.execute_insert(i, make_row(i))
+btree.execute_delete(6514)
+btree.execute_delete(6513)
+btree.execute_insert(6524, make_row(6524))
+if check_tree(btree) and [k for k, _ in btree.scan()] == list(range(6513)) + [6524]:
+    status = "PASSED ✅"
+
+print(f"{it}: {status}")
+
+# ----------------------------------------------------- #
+
+it = "matches a dict under random inserts and deletes for every split policy"
+status = "PASSED ✅"
+for policy in (EvenSplitPolicy, AppendSplitPolicy, AdaptiveSplitPolicy):
+    for leaf_capacity, internal_capacity in ((2, 2), (3, 3), (13, 500)):
+        rnd = random.Random(0)
+        btree = Btree(split_policy=policy(), leaf_capacity=leaf_capacity,
+                      internal_capacity=internal_capacity)
+        expected = {}
+        next_key = 0
+        for step in range(2000):
+            # mostly appends, so that the append split paths are taken
+            if rnd.random() < 0.5:
+                key = next_key if rnd.random() < 0.7 else rnd.randrange(next_key + 1)
+                next_key += 1
+                if key not in expected:
+                    btree.execute_insert(key, make_row(key))
+                    expected[key] = make_row(key)
+            elif expected:
+                key = max(expected) if rnd.random() < 0.5 else rnd.choice(list(expected))
+                btree.execute_delete(key)
+                del expected[key]
+        if not check_tree(btree) or list(btree.scan()) != sorted(expected.items()):
+            status = "FAILED ❌"
+
+print(f"{it}: {status}")
+
+# ----------------------------------------------------- #
+
+it = "reuses the pages freed before a FilePager is reopened"
+status = "PASSED ✅"
+filename = "test_free_pages.db"
+if os.path.exists(filename):
+    os.remove(filename)
+rnd = random.Random(0)
+expected = {}
+num_pages = []
+for _ in range(5):
+    btree = Btree(pager=FilePager(filename), leaf_capacity=4, internal_capacity=4)
+    for key in rnd.sample(range(2000), 400):
+        if key not in expected:
+            btree.execute_insert(key, make_row(key))
+            expected[key] = make_row(key)
+    for key in rnd.sample(sorted(expected), len(expected) * 2 // 3):
+        btree.execute_delete(key)
+        del expected[key]
+    btree._pager.close()
+    btree = Btree(pager=FilePager(filename), leaf_capacity=4, internal_capacity=4)
+    if not check_tree(btree) or list(btree.scan()) != sorted(expected.items()):
+        status = "FAILED ❌"
+    btree._pager.close()
+    num_pages.append(os.path.getsize(filename) // PAGE_SIZE)
+# the file stops growing once the deletes free as many pages as the inserts take
+if num_pages[-1] > num_pages[1] * 1.2:
+    status = "FAILED ❌"
+os.remove(filename)
+
+print(f"{it}: {status}")
+
+# ----------------------------------------------------- #
+
+it = "recovers a tree with a WAL after a crash, a checkpoint crash and a clean close"
+status = "PASSED ✅"
+filename = "test_wal.db"
+wal_filename = "test_wal.wal"
+for name in (filename, wal_filename):
+    if os.path.exists(name):
+        os.remove(name)
+
+def open_wal_tree():
+    return Btree(pager=FilePager(filename), wal=WriteAheadLog(wal_filename),
+                 leaf_capacity=4, internal_capacity=4)
+
+expected = {}
+btree = open_wal_tree()
+for key in range(200):
+    btree.execute_insert(key, make_row(key))
+    expected[key] = make_row(key)
+# crash after a commit: the file has nothing since the first checkpoint
+btree.execute_delete(7)
+del expected[7]
+btree.commit()
+btree._pager.close()
+btree._wal.close()
+btree = open_wal_tree()
+if not check_tree(btree) or list(btree.scan()) != sorted(expected.items()):
+    status = "FAILED ❌"
+# crash after a checkpoint is logged, before its pages are written
+for key in range(0, 200, 3):
+    if key in expected:
+        btree.execute_delete(key)
+        del expected[key]
+for page_num, page in btree._pager.page_images():
+    btree._wal.append(WAL_PAGE, page_num, page)
+btree._wal.append(WAL_CHECKPOINT_END, 0)
+btree._wal.close()
+btree._pager.close()
+btree = open_wal_tree()
+if not check_tree(btree) or list(btree.scan()) != sorted(expected.items()):
+    status = "FAILED ❌"
+# a clean close leaves nothing to replay
+btree.execute_insert(1000, make_row(1000))
+expected[1000] = make_row(1000)
+btree.close()
+if os.path.getsize(wal_filename) != 0:
+    status = "FAILED ❌"
+btree = open_wal_tree()
+if not check_tree(btree) or list(btree.scan()) != sorted(expected.items()):
+    status = "FAILED ❌"
+btree.close()
+for name in (filename, wal_filename):
+    os.remove(name)
+
+print(f"{it}: {status}")
+
+# ----------------------------------------------------- #
+
+it = "opens a file in the db.c format, with parent pointers and no trailer"
+status = "PASSED ✅"
+filename = "test_db_c.db"
+if os.path.exists(filename):
+    os.remove(filename)
+btree = Btree(pager=FilePager(filename), internal_capacity=3)
+for key in range(1, 201):
+    btree.execute_insert(key, make_row(key))
+btree._pager.close()
+# db.c keeps the parent page in the max key slot of internal nodes and
+# leaves the end of page 0 uninitialised
+with open(filename, "r+b") as f:
+    for page_num in range(os.path.getsize(filename) // PAGE_SIZE):
+        f.seek(page_num * PAGE_SIZE)
+        if f.read(1) == bytes([NODE_INTERNAL]):
+            f.seek(page_num * PAGE_SIZE + 2)
+            f.write(struct.pack("<I", 0))
+    f.seek(FILE_TRAILER_OFFSET)
+    f.write(bytes([0xAB] * FILE_TRAILER.size))
+expected = {key: make_row(key) for key in range(1, 201)}
+btree = Btree(pager=FilePager(filename), internal_capacity=3)
+if not check_tree(btree) or list(btree.scan()) != sorted(expected.items()):
+    status = "FAILED ❌"
+for key in range(3, 200, 4):
+    btree.execute_delete(key)
+    del expected[key]
+btree.close()
+btree = Btree(pager=FilePager(filename), internal_capacity=3)
+if not check_tree(btree) or list(btree.scan()) != sorted(expected.items()):
+    status = "FAILED ❌"
+btree.close()
+os.remove(filename)
+
+print(f"{it}: {status}")
+
+# ----------------------------------------------------- #
+
+it = "rejects keys and rows a FilePager cannot store before changing the tree"
+status = "PASSED ✅"
+filename = "test_cells.db"
+if os.path.exists(filename):
+    os.remove(filename)
+btree = Btree(pager=FilePager(filename))
+for key in range(20):
+    btree.execute_insert(key, make_row(key))
+long_row = {"id": 20, "user": "x" * 33, "email": "x"}
+for pairs in ([(20, long_row)], [(2 ** 32, make_row(20))], [(21, make_row(21)), (20, long_row)]):
+    try:
+        btree.execute_insert_many(pairs)
+        status = "FAILED ❌"
+    except Exception:
+        pass
+if [key for key, _ in btree.scan()] != list(range(20)):
+    status = "FAILED ❌"
+btree.close()
+os.remove(filename)
+
+print(f"{it}: {status}")
+
+# ----------------------------------------------------- #
+
+it = "rejects a row that cannot be indexed before storing it"
+status = "PASSED ✅"
+btree = Btree(leaf_capacity=4, internal_capacity=4)
+for key in range(50):
+    btree.execute_insert(key, make_row(key))
+btree.create_index("email")
+for bad_row in ({"id": 60, "email": ["x"]}, {"id": 61, "email": float("nan")}):
+    for pairs in ([(bad_row["id"], bad_row)], [(55, make_row(55)), (100, bad_row)]):
+        try:
+            btree.execute_insert_many(pairs)
+            status = "FAILED ❌"
+        except Exception:
+            pass
+    try:
+        btree.execute_insert(bad_row["id"], bad_row)
+        status = "FAILED ❌"
+    except Exception:
+        pass
+if [key for key, _ in btree.scan()] != list(range(50)) or len(list(btree.get_index("email").scan())) != 50:
+    status = "FAILED ❌"
+for key in range(50):
+    btree.execute_delete(key)
+if list(btree.scan()) or list(btree.get_index("email").scan()):
+    status = "FAILED ❌"
+
+print(f"{it}: {status}")
+
+# ----------------------------------------------------- #
+
+it = "leaves the tree unchanged when a batch has a duplicate of a key in the tree"
+status = "FAILED ❌"
+btree = Btree()
+for key in range(0, 1000, 2):
+    btree.execute_insert(key, make_row(key))
+try:
+    btree.execute_insert_many([(1, make_row(1)), (3, make_row(3)), (998, make_row(998))])
+except Exception:
+    if [key for key, _ in btree.scan()] == list(range(0, 1000, 2)):
+        status = "PASSED ✅"
+
+print(f"{it}: {status}")
+
+# ----------------------------------------------------- #
+
+it = "reads packed rows as views that outlive changes to their leaf"
+status = "PASSED ✅"
+btree = Btree(pager=Pager(row_layout=ROW_LAYOUT), leaf_capacity=8)
+for key in range(100):
+    btree.execute_insert(key, make_row(key))
+rows = list(btree.scan())
+row = btree.get(7)
+for key in range(0, 100, 2):
+    btree.execute_delete(key)
+for key in range(100, 150):
+    btree.execute_insert(key, make_row(key + 1))
+if rows != [(key, make_row(key)) for key in range(100)] or dict(row) != make_row(7):
+    status = "FAILED ❌"
+if row["email"] != "person7@example.com" or row.get("nope", 5) != 5 or sorted(row) != sorted(make_row(7)):
+    status = "FAILED ❌"
+if list(btree.scan_field("user", 140)) != [(key, f"person{key + 1}") for key in range(140, 150)]:
+    status = "FAILED ❌"
+
+print(f"{it}: {status}")
+
+# ----------------------------------------------------- #
+
+it = "encodes equal numbers of any type as one key, in numeric order"
+status = "PASSED ✅"
+numbers = [float("-inf"), -2 ** 70, -1e20, -2.5, -2, -1, -0.5, 0, 5e-324, 0.1, 0.5, 1, 1 + 2 ** -52,
+           2.5, 3, 2 ** 53 + 1, 1e20, 2 ** 70, float("inf")]
+keys = [encode_key(number) for number in numbers]
+if keys != sorted(keys) or len(set(keys)) != len(keys):
+    status = "FAILED ❌"
+if [decode_key(key) for key in keys] != numbers:
+    status = "FAILED ❌"
+if not encode_key(1) == encode_key(1.0) == encode_key(True) or encode_key(0) != encode_key(-0.0):
+    status = "FAILED ❌"
+if not encode_key((1, 2.5)) < encode_key((1.5, 0)) < encode_key((2.0, -1)) or decode_key(encode_key((2.0, 0.5))) != (2, 0.5):
+    status = "FAILED ❌"
+btree = Btree()
+btree.execute_insert(encode_key(1), make_row(1))
+if btree.get(encode_key(1.0)) != make_row(1):
+    status = "FAILED ❌"
+
+print(f"{it}: {status}")
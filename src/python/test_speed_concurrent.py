@@ -0,0 +1,72 @@
+import threading
+from random import randint, shuffle
+from time import perf_counter
+from btree import ConcurrentBtree
+
+
+N = 10 ** 5
+NUM_READERS = 4
+NUM_WRITERS = 2
+
+btree = ConcurrentBtree()
+
+def make_row(i):
+    return {"id": i, "user": f"person{i}", "email": f"person{i}@example.com"}
+
+# even keys are loaded up front and must stay visible throughout,
+# odd keys are inserted by the writers while the readers run
+btree.bulk_load([(i, make_row(i)) for i in range(0, N, 2)])
+data = [(i, make_row(i)) for i in range(1, N, 2)]
+shuffle(data)
+
+done = threading.Event()
+errors = []
+reads = [0] * NUM_READERS
+scans = [0] * NUM_READERS
+
+def writer(pairs):
+    for key, val in pairs:
+        btree.execute_insert(key, val)
+
+def reader(n):
+    try:
+        while not done.is_set():
+            key = 2 * randint(0, N // 2 - 1)
+            if btree.get(key) != make_row(key):
+                raise Exception(f"Lost key {key}")
+            reads[n] += 1
+            lo = 2 * randint(0, N // 2 - 1)
+            keys = [k for k, _ in btree.scan(lo, lo + 200)]
+            if keys != sorted(set(keys)) or not set(range(lo, min(lo + 201, N), 2)) <= set(keys):
+                raise Exception(f"Inconsistent scan from {lo}")
+            scans[n] += 1
+    except Exception as e:
+        errors.append(e)
+
+writers = [threading.Thread(target=writer, args=(data[i::NUM_WRITERS],))
+           for i in range(NUM_WRITERS)]
+readers = [threading.Thread(target=reader, args=(i,)) for i in range(NUM_READERS)]
+
+t1_start = perf_counter()
+for t in readers + writers:
+    t.start()
+for t in writers:
+    t.join()
+t1_stop = perf_counter()
+done.set()
+for t in readers:
+    t.join()
+
+if errors:
+    raise errors[0]
+if [k for k, _ in btree.scan()] != list(range(N)):
+    raise Exception("Keys missing after the run")
+
+delta_t = round(t1_stop - t1_start, 3)
+print(f"Elapsed time (N = {N}, {NUM_WRITERS} writers, {NUM_READERS} readers): {delta_t}")
+print(f"Inserts/s: {round(len(data) / delta_t)}")
+print(f"Gets/s: {round(sum(reads) / delta_t)}")
+print(f"Scans/s (201 keys): {round(sum(scans) / delta_t)}")
+btree.print_split_counts()
+
+# results: 1.365, 1.1, 1.015
@@ -0,0 +1,34 @@
+import os
+from random import randint
+from time import perf_counter
+from btree import ShardedBtree
+
+
+N = 10 ** 5
+data = []
+for i in range(N):
+    val = {"id": i, "user": f"person{i}", "email": f"person{i}@example.com"}
+    data.append((i, val))
+
+# shuffle input data
+for i in reversed(range(len(data))):
+    j = randint(0, i)
+    data[i], data[j] = data[j], data[i]
+
+# ingest throughput by number of shards, up to the number of cores;
+# boundaries start even over the keys so that no rebalancing is needed
+num_shards = 1
+while num_shards <= (os.cpu_count() or 1):
+    boundaries = [(i + 1) * N // num_shards for i in range(num_shards - 1)]
+    with ShardedBtree(num_shards=num_shards, boundaries=boundaries) as btree:
+        t1_start = perf_counter()
+        for key, val in data:
+            btree.execute_insert(key, val)
+        btree.flush()
+        t1_stop = perf_counter()
+
+    delta_t = round(t1_stop - t1_start, 3)
+    print(f"Elapsed time (N = {N}, {num_shards} shards): {delta_t}, inserts/s: {round(N / delta_t)}")
+    num_shards *= 2
+
+# results (1 core): 1.035